@@ -0,0 +1,239 @@
+"""
+Hardware-free benchmarks for the render, input and protocol hot paths.
+
+Knobs run on luma's dummy display device and gpiozero MockFactory pins, and the
+client talks to a local PiPedal stand-in server, so this runs on any Linux box.
+Results are written as JSON so runs can be compared across changes.
+
+Usage:
+    python -m benchmarks [--quick] [--output results.json] [--font /path/to/font.ttf] [--log-level debug]
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+import types
+
+import util
+from util import log
+from benchmarks.standin import PiPedalStandIn, synthetic_pedalboard
+
+async def bench_detents(detents: int) -> dict:
+    """
+    Detents per second from encoder edges to model update and send queue.
+    """
+    from gpiozero.pins.mock import MockFactory
+    from luma.core.device import dummy
+    from knobs.backends import GPIOInput
+    from knobs.knob import Knob
+    from pipedalclient import PiPedalClient
+
+    standin = PiPedalStandIn(synthetic_pedalboard(8, 16))
+    await standin.start()
+    client = await PiPedalClient.create(standin.url)
+    await client.connect()
+
+    factory = MockFactory()
+    input = GPIOInput(17, 18, 27, pin_factory=factory)
+    knob = Knob(types.SimpleNamespace(pedal_client=client), 0x3c, device=dummy(), input=input)
+    pin_a, pin_b = factory.pin(17), factory.pin(18)
+    encoder = input.encoder
+
+    # far faster than a hand can turn, so drive bursts that fit the edge ring buffer
+    burst = encoder.RING_SIZE // 8
+    start = time.perf_counter()
+    for i in range(0, detents, burst):
+        for _ in range(min(burst, detents - i)):
+            # one clockwise detent
+            pin_a.drive_low()
+            pin_b.drive_low()
+            pin_a.drive_high()
+            pin_b.drive_high()
+        while encoder.detents_decoded < min(i + burst, detents):
+            await asyncio.sleep(encoder.TICK / 10)
+    elapsed = time.perf_counter() - start
+
+    # let the send queue flush
+    await asyncio.sleep(0.2)
+    result = {
+        "detents": detents,
+        "seconds": elapsed,
+        "detents_per_second": detents / elapsed,
+        "batches": encoder.batches,
+        "overflows": encoder.overflows,
+        "values_sent": client.control_queue.values_sent,
+        "values_dropped": client.control_queue.values_dropped,
+    }
+    knob.close()
+    await client.close()
+    await standin.close()
+    return result
+
+async def bench_menu_render(frames: int) -> dict:
+    """
+    Frames per second of the animated SELECT_ITEM circle menu, rendered synchronously.
+    """
+    from gpiozero.pins.mock import MockFactory
+    from luma.core.device import dummy
+    from knobs.knob import Knob, KnobMode
+    from knobs.rendercache import render_cache
+    from pipedalclient import PiPedalClient
+
+    class BenchmarkKnob(Knob):
+        # keeps the render thread from competing with the benchmark
+        MAX_FPS = 1
+
+    standin = PiPedalStandIn(synthetic_pedalboard(12, 8))
+    await standin.start()
+    client = await PiPedalClient.create(standin.url)
+    await client.connect()
+
+    knob = BenchmarkKnob(types.SimpleNamespace(pedal_client=client), 0x3c, 17, 18, 27, device=dummy(), pin_factory=MockFactory())
+    knob.mode = KnobMode.SELECT_ITEM
+    items = client.pedalboard.items
+
+    position = 0
+    direction = 1
+    start = time.perf_counter()
+    for frame in range(frames):
+        if frame % 4 == 0:
+            if not 0 <= position + direction < len(items):
+                direction = -direction
+            position += direction
+            knob.select_item_animated(items[position])
+        knob.render(time.monotonic())
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "frames": frames,
+        "seconds": elapsed,
+        "frames_per_second": frames / elapsed,
+        "render_cache": render_cache.stats(),
+    }
+    knob.close()
+    await client.close()
+    await standin.close()
+    return result
+
+async def bench_dispatch(messages: int) -> dict:
+    """
+    onControlChanged messages per second handled by the client's receive loop.
+    """
+    from pipedalclient import PiPedalClient
+
+    standin = PiPedalStandIn(synthetic_pedalboard(8, 16))
+    await standin.start()
+    client = await PiPedalClient.create(standin.url)
+    await client.connect()
+
+    final_value = 2.0
+    frames = [
+        json.dumps([{"message": "onControlChanged"}, {
+            "clientId": -2,
+            "instanceId": 1 + i % 8,
+            "symbol": f"control{i % 16}",
+            "value": i / messages,
+        }])
+        for i in range(messages - 1)
+    ]
+    frames.append(json.dumps([{"message": "onControlChanged"}, {"clientId": -2, "instanceId": 1, "symbol": "control0", "value": final_value}]))
+
+    done = asyncio.Event()
+    client.pedalboard.item(1).control("control0").on_value_changed.add_listener(lambda value: done.set() if value == final_value else None)
+
+    start = time.perf_counter()
+    await standin.broadcast(frames)
+    await done.wait()
+    elapsed = time.perf_counter() - start
+
+    await client.close()
+    await standin.close()
+    return {
+        "messages": messages,
+        "seconds": elapsed,
+        "messages_per_second": messages / elapsed,
+    }
+
+async def bench_pedalboard(sizes: list[tuple[int, int]], repeat: int) -> list[dict]:
+    """
+    Cost of building a pedalboard model and of reconciling a changed one into it.
+    """
+    from pipedalclient import PiPedalClient, Pedalboard
+
+    client = await PiPedalClient.create("ws://127.0.0.1:1/unused")
+    results = []
+    for items, controls in sizes:
+        pedalboard_json = synthetic_pedalboard(items, controls)
+        changed_json = synthetic_pedalboard(items, controls)
+        for item in changed_json["items"]:
+            for control in item["controlValues"]:
+                control["value"] = 0.25
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            Pedalboard(client, pedalboard_json)
+        build = (time.perf_counter() - start) / repeat
+
+        pedalboard = Pedalboard(client, pedalboard_json)
+        start = time.perf_counter()
+        for i in range(repeat):
+            pedalboard.update(changed_json if i % 2 == 0 else pedalboard_json)
+        reconcile = (time.perf_counter() - start) / repeat
+
+        results.append({
+            "items": items,
+            "controls_per_item": controls,
+            "build_seconds": build,
+            "reconcile_seconds": reconcile,
+        })
+    return results
+
+async def run(quick: bool) -> dict:
+    scale = 0.1 if quick else 1.0
+    return {
+        "detents": await bench_detents(int(5000 * scale)),
+        "menu_render": await bench_menu_render(int(2000 * scale)),
+        "dispatch": await bench_dispatch(int(20000 * scale)),
+        "pedalboard": await bench_pedalboard([(10, 20), (50, 50), (200, 100)], max(int(20 * scale), 2)),
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Hardware-free benchmarks for pipedal-knob.")
+    parser.add_argument("--quick", action="store_true", help="run a tenth of the iterations")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--font", help=f"font to render with (default: {util.FONT_PATH_SANS})")
+    parser.add_argument("--log-level", default="debug", choices=log.LEVELS, help="level of the log records written to /dev/null during the runs (default: debug)")
+    args = parser.parse_args()
+
+    if args.font is not None:
+        # must happen before the knobs package creates the shared render cache
+        util.FONT_PATH_SANS = args.font
+
+    # the hot paths log, which is part of what is measured; rate limited like config.yml does
+    log_writer = log.configure({"level": args.log_level, "file": os.devnull, "rate_limit": 20})
+    try:
+        results = asyncio.run(run(args.quick))
+    finally:
+        log_writer.close()
+
+    report = {
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "log_level": args.log_level,
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Replays a websocket traffic capture against the client through a local PiPedal stand-in.
+
+Captures are recorded by starting pipedal-knob with capture_file set in config.yml.
+The stand-in serves the first pedalboard found in the capture and then plays the
+frames PiPedal pushed to the client (onControlChanged, onPedalboardChanged, ...)
+at the recorded pace, scaled by --speed, or as fast as possible with --max.
+Replies to the client's own requests are not replayed, the stand-in answers those.
+Handler throughput and memory use of the client are reported as JSON.
+
+Usage:
+    python -m benchmarks.replay capture.log.gz [--speed N | --max] [--output results.json] [--log-level debug]
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+import time
+import tracemalloc
+
+from benchmarks.standin import PiPedalStandIn
+from pipedalclient.traffic import read_traffic, INBOUND, TrafficFrame
+from util import log
+from util.metrics import metrics
+
+def load_capture(path: str) -> tuple[dict, list[TrafficFrame]]:
+    """
+    :return: The first pedalboard in the capture and the frames pushed by the server.
+    """
+    pedalboard = None
+    pushed: list[TrafficFrame] = []
+    for entry in read_traffic(path):
+        if entry.direction != INBOUND:
+            continue
+        root = json.loads(entry.frame)
+        message = root[0].get("message")
+        if pedalboard is None:
+            if message == "currentPedalboard":
+                pedalboard = root[1]
+            elif message == "onPedalboardChanged":
+                pedalboard = root[1]["pedalboard"]
+        if root[0].get("reply") is None:
+            pushed.append(entry)
+    if pedalboard is None:
+        raise ValueError(f"{path} does not contain a pedalboard")
+    return pedalboard, pushed
+
+async def replay(path: str, speed: float) -> dict:
+    from pipedalclient import PiPedalClient
+
+    pedalboard, frames = load_capture(path)
+    standin = PiPedalStandIn(pedalboard, echo=True)
+    await standin.start()
+    client = await PiPedalClient.create(standin.url)
+    await client.connect()
+
+    dispatched = metrics.histogram("pipedal_message_dispatch_seconds", labels={"server": standin.url})
+    dispatched_before = dispatched.count
+
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    first = frames[0].time if len(frames) > 0 else 0.0
+    for entry in frames:
+        if speed > 0:
+            delay = (entry.time - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await standin.broadcast([entry.frame])
+    while dispatched.count - dispatched_before < len(frames):
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "capture": path,
+        "speed": speed if speed > 0 else "max",
+        "frames": len(frames),
+        "seconds": elapsed,
+        "frames_per_second": len(frames) / elapsed if elapsed > 0 else None,
+        "dispatch_seconds_total": dispatched.sum,
+        "memory_growth_bytes": memory_after - memory_before,
+        "memory_peak_bytes": memory_peak,
+        "values_sent": client.control_queue.values_sent,
+        "remote_changes_applied": client.remote_changes_applied,
+    }
+    await client.close()
+    await standin.close()
+    return result
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.replay", description="Replay a PiPedal traffic capture against the client.")
+    parser.add_argument("capture", help="capture file recorded with capture_file")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--speed", type=float, default=1.0, help="playback speed factor (default: 1)")
+    group.add_argument("--max", action="store_true", help="play back as fast as possible")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--log-level", default="debug", choices=log.LEVELS, help="level of the log records written to /dev/null during the replay (default: debug)")
+    args = parser.parse_args()
+
+    log_writer = log.configure({"level": args.log_level, "file": os.devnull, "rate_limit": 20})
+    try:
+        result = asyncio.run(replay(args.capture, 0 if args.max else args.speed))
+    finally:
+        log_writer.close()
+
+    output = json.dumps(result, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+from __future__ import annotations
+from typing import Any, Optional
+import asyncio
+import json
+import struct
+
+import websockets
+
+def synthetic_pedalboard(items: int, controls: int, name: str = "Benchmark") -> dict:
+    """
+    Build pedalboard JSON in the format PiPedal sends it, with the given number
+    of items and controls per item.
+    """
+    return {
+        "name": name,
+        "items": [
+            {
+                "instanceId": i + 1,
+                "uri": f"urn:benchmark:plugin{i % 8}",
+                "isEnabled": True,
+                "pluginName": f"Plugin {i + 1}",
+                "controlValues": [{"key": f"control{j}", "value": 0.5} for j in range(controls)],
+            }
+            for i in range(items)
+        ],
+    }
+
+def to_float32(value: float) -> float:
+    # PiPedal stores control values as 32 bit floats
+    return struct.unpack("f", struct.pack("f", value))[0]
+
+class PiPedalStandIn():
+    """
+    Minimal local stand-in for a PiPedal server. Answers hello,
+    currentPedalboard and plugins, applies and echoes setControl and can
+    broadcast arbitrary frames to all connected clients.
+    """
+
+    def __init__(self, pedalboard: dict, echo: bool = True, plugins: Optional[list[dict]] = None, echo_delay: float = 0.0):
+        """
+        :param echo_delay: Seconds by which echoes of setControl lag behind, in order, like a busy server's.
+        """
+        self.pedalboard: dict = pedalboard
+        self.echo_delay: float = echo_delay
+        self.plugins: list[dict] = plugins if plugins is not None else []
+        self.echo: bool = echo
+        self.received: list[list] = []
+        self.__connections: set = set()
+        self.__server: Optional[websockets.Server] = None
+        self.__next_client_id: int = 1
+
+    @property
+    def url(self) -> str:
+        port = self.__server.sockets[0].getsockname()[1]
+        return f"ws://127.0.0.1:{port}/pipedal"
+
+    async def start(self, port: int = 0) -> None:
+        self.__server = await websockets.serve(self.__handle, "127.0.0.1", port, max_size=None)
+
+    async def close(self) -> None:
+        self.__server.close()
+        for connection in list(self.__connections):
+            await connection.close()
+        await self.__server.wait_closed()
+
+    async def broadcast(self, frames: list[str]) -> None:
+        for connection in list(self.__connections):
+            for frame in frames:
+                await connection.send(frame)
+
+    async def __handle(self, connection) -> None:
+        self.__connections.add(connection)
+        client_id = self.__next_client_id
+        self.__next_client_id += 1
+        try:
+            async for frame in connection:
+                root = json.loads(frame)
+                self.received.append(root)
+                await self.__reply(connection, client_id, root)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.__connections.discard(connection)
+
+    async def __reply(self, connection, client_id: int, root: list) -> None:
+        message = root[0].get("message")
+        reply_to = root[0].get("replyTo")
+        body: Any = root[1] if len(root) > 1 else None
+
+        if message == "hello":
+            await connection.send(json.dumps([{"reply": reply_to, "message": "ehlo"}, client_id]))
+        elif message == "currentPedalboard":
+            await connection.send(json.dumps([{"reply": reply_to, "message": "currentPedalboard"}, self.pedalboard]))
+        elif message == "plugins":
+            await connection.send(json.dumps([{"reply": reply_to, "message": "plugins"}, self.plugins]))
+        elif message == "setControl":
+            value = to_float32(body["value"])
+            for item in self.pedalboard["items"]:
+                if item["instanceId"] == body["instanceId"]:
+                    for control in item["controlValues"]:
+                        if control["key"] == body["symbol"]:
+                            control["value"] = value
+            if self.echo:
+                frame = json.dumps([{"message": "onControlChanged"}, {
+                    "clientId": body["clientId"],
+                    "instanceId": body["instanceId"],
+                    "symbol": body["symbol"],
+                    "value": value,
+                }])
+                if self.echo_delay > 0:
+                    # timers with the same delay fire in order, so the echoes stay in order
+                    asyncio.get_running_loop().call_later(self.echo_delay, lambda: asyncio.ensure_future(connection.send(frame)))
+                else:
+                    await connection.send(frame)
+        elif reply_to is not None:
+            await connection.send(json.dumps([{"reply": reply_to, "message": "error"}, f"Unsupported message {message}"]))
@@ -1,7 +1,80 @@
-from typing import TypeVar, Generic, Callable
+from __future__ import annotations
+from typing import TypeVar, Generic, Callable, Optional, Union
+from concurrent.futures import Executor
+import asyncio
+import inspect
+import threading
+import weakref
 
 T = TypeVar("T")
 
+class Subscription():
+    """
+    A handler attached to an event. Closing the subscription detaches the handler.
+    Closing it again, or after the handler's object was garbage collected, does nothing.
+    """
+    __slots__ = ("__event", "__entry", "__weakref__")
+
+    def __init__(self, event: "Event", entry: "_Handler"):
+        self.__event: Optional[weakref.ref[Event]] = weakref.ref(event)
+        self.__entry = entry
+
+    @property
+    def active(self) -> bool:
+        event = self.__event() if self.__event is not None else None
+        return event is not None and event._contains(self.__entry)
+
+    def close(self) -> None:
+        event = self.__event() if self.__event is not None else None
+        self.__event = None
+        if event is not None:
+            event._remove(self.__entry)
+
+    def __enter__(self) -> "Subscription":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+class SubscriptionGroup():
+    """
+    Collects subscriptions so that they can be closed together, e.g. when the
+    object that subscribed is closed.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__subscriptions: list[Subscription] = []
+
+    def add(self, subscription: Subscription) -> Subscription:
+        with self.__lock:
+            self.__subscriptions.append(subscription)
+        return subscription
+
+    def close(self) -> None:
+        with self.__lock:
+            subscriptions = self.__subscriptions
+            self.__subscriptions = []
+        for subscription in subscriptions:
+            subscription.close()
+
+    def __len__(self) -> int:
+        return len(self.__subscriptions)
+
+class _Handler():
+    __slots__ = ("callback", "loop", "executor", "is_coroutine")
+
+    def __init__(self, callback: Union[Callable, weakref.WeakMethod], loop: Optional[asyncio.AbstractEventLoop], executor: Optional[Executor], is_coroutine: bool):
+        self.callback = callback
+        self.loop = loop
+        self.executor = executor
+        self.is_coroutine = is_coroutine
+
+    def resolve(self) -> Optional[Callable]:
+        if isinstance(self.callback, weakref.WeakMethod):
+            return self.callback()
+        return self.callback
+
 class Event(Generic[T]):
     """
     C#-style event class for Python.
@@ -10,30 +83,95 @@ class Event(Generic[T]):
     is triggered, all attached handlers will be called with the provided
     arguments.
 
+    Handlers may be added and removed from any thread, also while the event
+    is being triggered. Every change replaces the tuple of handlers instead
+    of modifying it, so triggering iterates over a snapshot without locking.
+
+    Bound methods are only weakly referenced: once their object is garbage
+    collected, the handler is removed. Other callables, e.g. lambdas, are kept
+    alive by the event until they are removed.
+
     Example usage:
         event = Event()
-        
+
         def handler(arg):
             print(f"Handler called with arg: {arg}")
-        
-        event += handler
-        event.trigger("Hello, World!")  # This will call the handler with "Hello, World!"
-        
-        event -= handler
-        event.trigger("This will not be printed")  # No handlers are attached, so nothing happens.
+
+        subscription = event.add_listener(handler)
+        event("Hello, World!")  # This will call the handler with "Hello, World!"
+
+        subscription.close()
+        event("This will not be printed")  # No handlers are attached, so nothing happens.
     """
 
     def __init__(self):
-        self.handlers = []
+        self.__lock = threading.Lock()
+        self.__handlers: tuple[_Handler, ...] = ()
 
-    def add_listener(self, handler: Callable[[T], None]) -> "Event[T]":
-        self.handlers.append(handler)
-        return self
-    
-    def remove_listener(self, handler: Callable[[T], None]) -> "Event[T]":
-        self.handlers.remove(handler)
-        return self
+    @property
+    def handlers(self) -> list[Callable[[T], None]]:
+        return [callback for callback in (entry.resolve() for entry in self.__handlers) if callback is not None]
+
+    def add_listener(self, handler: Callable[[T], None], loop: Optional[asyncio.AbstractEventLoop] = None, executor: Optional[Executor] = None) -> Subscription:
+        """
+        :param handler: Function or coroutine function called with the event argument.
+        :param loop: Call the handler on this event loop instead of the triggering thread.
+            Coroutine functions are run as tasks on this loop, or on the loop running
+            in the triggering thread if not given.
+        :param executor: Call the handler on this executor instead of the triggering thread.
+        :return: Subscription that detaches the handler when closed.
+        """
+        is_coroutine = inspect.iscoroutinefunction(handler)
+        if inspect.ismethod(handler):
+            # the weak reference to the event avoids a reference cycle through the callback
+            event = weakref.ref(self)
+            def on_collected(callback: weakref.WeakMethod) -> None:
+                alive = event()
+                if alive is not None:
+                    alive.__remove_collected(callback)
+            callback = weakref.WeakMethod(handler, on_collected)
+        else:
+            callback = handler
+        entry = _Handler(callback, loop, executor, is_coroutine)
+        with self.__lock:
+            self.__handlers = self.__handlers + (entry,)
+        return Subscription(self, entry)
+
+    def remove_listener(self, handler: Callable[[T], None]) -> None:
+        with self.__lock:
+            for i, entry in enumerate(self.__handlers):
+                if entry.resolve() == handler:
+                    self.__handlers = self.__handlers[:i] + self.__handlers[i + 1:]
+                    return
+        raise ValueError(f"{handler} is not a listener of this event")
+
+    def __len__(self) -> int:
+        return len(self.__handlers)
 
     def __call__(self, arg: T) -> None:
-        for handler in self.handlers:
-            handler(arg)
\ No newline at end of file
+        for entry in self.__handlers:
+            handler = entry.resolve()
+            if handler is None:
+                continue
+            if entry.is_coroutine:
+                if entry.loop is not None:
+                    asyncio.run_coroutine_threadsafe(handler(arg), entry.loop)
+                else:
+                    asyncio.get_running_loop().create_task(handler(arg))
+            elif entry.loop is not None:
+                entry.loop.call_soon_threadsafe(handler, arg)
+            elif entry.executor is not None:
+                entry.executor.submit(handler, arg)
+            else:
+                handler(arg)
+
+    def _contains(self, entry: _Handler) -> bool:
+        return entry in self.__handlers
+
+    def _remove(self, entry: _Handler) -> None:
+        with self.__lock:
+            self.__handlers = tuple(x for x in self.__handlers if x is not entry)
+
+    def __remove_collected(self, callback: weakref.WeakMethod) -> None:
+        with self.__lock:
+            self.__handlers = tuple(x for x in self.__handlers if x.callback is not callback)
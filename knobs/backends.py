@@ -0,0 +1,202 @@
+from __future__ import annotations
+from typing import Callable, Optional
+import collections
+import os
+import threading
+import time
+
+from luma.core.device import device as luma_device, dummy
+from PIL import Image
+from knobs.encoder import EncoderReader
+from knobs.i2cbus import I2CBusArbiter
+
+DISPLAY_BACKENDS = ("ssd1306", "simulator")
+INPUT_BACKENDS = ("gpio", "scripted")
+
+def open_ssd1306(bus: I2CBusArbiter, address: int) -> luma_device:
+    from luma.oled.device import ssd1306
+    serial = bus.serial(address)
+    # initializing sends commands, which must not interleave with other displays' frames
+    return bus.call(lambda: ssd1306(serial, rotate=0))
+
+class SimulatorDevice(dummy):
+    """
+    Headless stand-in for the SSD1306. Keeps the last frames it was sent in
+    memory and optionally writes every frame to a PNG file, numbered per display.
+    """
+
+    def __init__(self, name: str = "display", keep_frames: int = 1, png_dir: Optional[str] = None, width: int = 128, height: int = 64):
+        super().__init__(width=width, height=height, mode="1")
+        # keep the last frame on exit instead of clearing the display like luma does
+        self.persist = True
+        self.name: str = name
+        self.frames: collections.deque[Image.Image] = collections.deque(maxlen=keep_frames)
+        self.frame_count: int = 0
+        self.__png_dir = png_dir
+        if png_dir is not None:
+            os.makedirs(png_dir, exist_ok=True)
+
+    def display(self, image: Image.Image) -> None:
+        super().display(image)
+        self.frame_count += 1
+        self.frames.append(self.image)
+        if self.__png_dir is not None:
+            self.image.save(os.path.join(self.__png_dir, f"{self.name}-{self.frame_count:06d}.png"))
+
+class InputBackend():
+    """
+    Source of a knob's rotation and button events. The knob assigns the
+    callbacks and then calls start(). Callbacks may be called from any thread.
+    """
+
+    def __init__(self):
+        self.when_rotated: Optional[Callable[[int, float, float], None]] = None
+        """Called with the detents turned since the last call (positive clockwise), the turning speed in detents per second and the time.perf_counter() time of the first of these detents."""
+        self.when_pressed: Optional[Callable[[], None]] = None
+        self.when_held: Optional[Callable[[], None]] = None
+
+    def start(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def _rotated(self, delta: int, velocity: float, started: Optional[float] = None) -> None:
+        callback = self.when_rotated
+        if callback is not None:
+            callback(delta, velocity, started if started is not None else time.perf_counter())
+
+    def _pressed(self) -> None:
+        callback = self.when_pressed
+        if callback is not None:
+            callback()
+
+    def _held(self) -> None:
+        callback = self.when_held
+        if callback is not None:
+            callback()
+
+class GPIOInput(InputBackend):
+    """
+    Rotary encoder and push button on GPIO pins, read with gpiozero. The encoder
+    is decoded in batches by an EncoderReader, see there.
+    """
+    HOLD_TIME = 3
+    BOUNCE_TIME = 0.05
+
+    def __init__(self, rotary_pin1: int, rotary_pin2: int, push_pin: int, pin_factory = None, name: str = "input", metric_labels: Optional[dict[str, str]] = None):
+        """
+        :param pin_factory: gpiozero pin factory, e.g. a MockFactory.
+        """
+        super().__init__()
+        from gpiozero import Button
+
+        self.__encoder = EncoderReader(rotary_pin1, rotary_pin2, self._rotated, pin_factory=pin_factory, name=name, metric_labels=metric_labels)
+
+        self.__button = Button(pin=push_pin, bounce_time=self.BOUNCE_TIME, pin_factory=pin_factory)
+        self.__button.when_activated = lambda x: self._pressed()
+        self.__button.hold_time = self.HOLD_TIME
+        self.__button.when_held = lambda x: self._held()
+
+    @property
+    def encoder(self) -> EncoderReader:
+        return self.__encoder
+
+    def close(self) -> None:
+        self.__encoder.close()
+        self.__button.close()
+
+class ScriptedInput(InputBackend):
+    """
+    Plays a script of input events on a background thread, e.g. to soak-test
+    knobs without hardware. Every step is one of "turn <detents> [<detents per
+    second>]" (negative detents for counter-clockwise), "press", "hold" or
+    "wait <seconds>". A turn is reported as one batch, like the encoder reader
+    reports the detents of one tick. turn(), press() and hold() may also be
+    called directly.
+    """
+
+    def __init__(self, script: list[str], repeat: bool = False, name: str = "input"):
+        super().__init__()
+        self.__script: list[tuple[str, float, float]] = [self.__parse(step) for step in script]
+        self.__repeat = repeat
+        self.__name = name
+        self.__stop = threading.Event()
+        self.__thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def __parse(step: str) -> tuple[str, float, float]:
+        parts = step.split()
+        if len(parts) in (2, 3) and parts[0] == "turn":
+            return parts[0], float(parts[1]), float(parts[2]) if len(parts) == 3 else 0.0
+        if len(parts) == 2 and parts[0] == "wait":
+            return parts[0], float(parts[1]), 0.0
+        if len(parts) == 1 and parts[0] in ("press", "hold"):
+            return parts[0], 0.0, 0.0
+        raise ValueError(f"Invalid input script step: {step!r}")
+
+    def turn(self, detents: int, velocity: float = 0.0) -> None:
+        if detents != 0:
+            self._rotated(detents, velocity)
+
+    def press(self) -> None:
+        self._pressed()
+
+    def hold(self) -> None:
+        self._held()
+
+    def start(self) -> None:
+        if len(self.__script) == 0 or self.__thread is not None:
+            return
+        self.__thread = threading.Thread(target=self.__run, name=self.__name, daemon=True)
+        self.__thread.start()
+
+    def close(self) -> None:
+        self.__stop.set()
+        if self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join()
+
+    def __run(self) -> None:
+        while not self.__stop.is_set():
+            for action, argument, velocity in self.__script:
+                if self.__stop.is_set():
+                    return
+                if action == "turn":
+                    self.turn(int(argument), velocity)
+                elif action == "press":
+                    self.press()
+                elif action == "hold":
+                    self.hold()
+                elif action == "wait":
+                    self.__stop.wait(argument)
+            if not self.__repeat:
+                return
+
+def create_display(backend_config: dict, display_addr: int, i2c_port: int) -> tuple[luma_device, Optional[I2CBusArbiter]]:
+    """
+    Create the display of a knob for the display backend selected in config.yml.
+    :return: The display and the arbiter of its I2C bus, if it has one.
+    """
+    backend = backend_config.get("display", "ssd1306")
+    if backend == "ssd1306":
+        bus = I2CBusArbiter.for_port(i2c_port)
+        return open_ssd1306(bus, display_addr), bus
+    if backend == "simulator":
+        device = SimulatorDevice(
+            name=f"{i2c_port}-{display_addr:#x}",
+            keep_frames=int(backend_config.get("simulator_keep_frames", 1)),
+            png_dir=backend_config.get("simulator_png_dir"))
+        return device, None
+    raise ValueError(f"Unknown display backend {backend!r}, expected one of {', '.join(DISPLAY_BACKENDS)}")
+
+def create_input(backend_config: dict, knob_config: dict, name: str) -> InputBackend:
+    """
+    Create the input of a knob for the input backend selected in config.yml.
+    """
+    backend = backend_config.get("input", "gpio")
+    if backend == "gpio":
+        return GPIOInput(knob_config["rotary_pin1"], knob_config["rotary_pin2"], knob_config["push_pin"], name=f"encoder-{name}", metric_labels={"display": name})
+    if backend == "scripted":
+        script = knob_config.get("input_script", backend_config.get("input_script", []))
+        return ScriptedInput(script, repeat=bool(backend_config.get("input_script_repeat", False)), name=f"input-{name}")
+    raise ValueError(f"Unknown input backend {backend!r}, expected one of {', '.join(INPUT_BACKENDS)}")
@@ -0,0 +1,192 @@
+from __future__ import annotations
+from typing import Callable, Optional
+import collections
+import threading
+import time
+
+from util.metrics import metrics
+
+# (a << 1) | b of the raw pin levels; the pins are pulled up, so the idle state is 0b11
+IDLE_STATE = 0b11
+# state transitions of a clockwise turn, a falling before b; the reverse transitions are counter-clockwise
+_CLOCKWISE = {(0b11, 0b01), (0b01, 0b00), (0b00, 0b10), (0b10, 0b11)}
+_COUNTER_CLOCKWISE = {(new, old) for old, new in _CLOCKWISE}
+
+class QuadratureDecoder():
+    """
+    Decodes the edges of a quadrature encoder's two pins into detents.
+
+    Quarter steps are accumulated between two visits of the idle state, and a
+    detent is counted when the idle state is reached after at least two quarter
+    steps in the same direction. Contact bounce within a detent cancels out, and
+    a single missed edge does not lose the detent.
+    """
+
+    def __init__(self, a: int = 1, b: int = 1):
+        self.__state: int = (a << 1) | b
+        self.__quarters: int = 0
+        self.invalid_transitions: int = 0
+
+    def feed(self, pin: int, level: int) -> int:
+        """
+        :param pin: 0 for pin a, 1 for pin b.
+        :param level: New raw level of the pin.
+        :return: 1 for a clockwise detent, -1 for a counter-clockwise one, otherwise 0.
+        """
+        if pin == 0:
+            new = (level << 1) | (self.__state & 1)
+        else:
+            new = (self.__state & 2) | level
+        transition = (self.__state, new)
+        self.__state = new
+        if transition in _CLOCKWISE:
+            self.__quarters += 1
+        elif transition in _COUNTER_CLOCKWISE:
+            self.__quarters -= 1
+        elif transition[0] != new:
+            self.invalid_transitions += 1
+
+        if new != IDLE_STATE:
+            return 0
+        quarters = self.__quarters
+        self.__quarters = 0
+        if quarters >= 2:
+            return 1
+        if quarters <= -2:
+            return -1
+        return 0
+
+class EncoderReader():
+    """
+    Reads a rotary encoder on two GPIO pins without doing any work per edge.
+
+    The pin callbacks only append the edge with its timestamps to a ring buffer:
+    the pin factory's ticks, for the intervals between detents, and
+    time.perf_counter(), for the input latency, since the two clocks are not
+    comparable on every pin factory.
+    A reader thread wakes up once per TICK while edges arrive, decodes all edges
+    of the tick in one batch and reports the accumulated detents together with
+    the turning speed and the time of the batch's first edge, so a fast turn
+    causes one model update per tick instead of one per detent. The speed is a moving average of the detent rate in
+    detents per second, and drops to 0 once the knob rests for IDLE_TIME.
+    """
+    TICK = 0.01
+    IDLE_TIME = 0.25
+    RING_SIZE = 1024
+    VELOCITY_SMOOTHING = 0.5
+
+    def __init__(self, pin_a: int, pin_b: int, on_rotated: Callable[[int, float, float], None], pin_factory = None, name: Optional[str] = None, metric_labels: Optional[dict[str, str]] = None):
+        """
+        :param on_rotated: Called on the reader thread with the detents turned (positive clockwise), the speed and the time.perf_counter() time of the first edge.
+        :param pin_factory: gpiozero pin factory, e.g. a MockFactory.
+        """
+        from gpiozero import InputDevice
+
+        self.__on_rotated = on_rotated
+        self.__edges: collections.deque[tuple[float, float, int, int]] = collections.deque(maxlen=self.RING_SIZE)
+        self.__pending = threading.Event()
+        self.__closed: bool = False
+
+        self.__a = InputDevice(pin_a, pull_up=True, pin_factory=pin_factory)
+        self.__b = InputDevice(pin_b, pull_up=True, pin_factory=pin_factory)
+        self.__factory = self.__a.pin_factory
+        self.__decoder = QuadratureDecoder(int(self.__a.pin.state), int(self.__b.pin.state))
+        self.__last_detent: Optional[float] = None
+        self.__velocity: float = 0.0
+
+        self.edges_decoded: int = 0
+        self.detents_decoded: int = 0
+        self.batches: int = 0
+        self.overflows: int = 0
+
+        metrics.gauge("encoder_edges_total", lambda: self.edges_decoded, "Encoder edges decoded", metric_labels)
+        metrics.gauge("encoder_detents_total", lambda: self.detents_decoded, "Encoder detents decoded", metric_labels)
+        metrics.gauge("encoder_batches_total", lambda: self.batches, "Batches of encoder edges decoded", metric_labels)
+        metrics.gauge("encoder_overflows_total", lambda: self.overflows, "Batches in which the edge ring buffer may have overflowed", metric_labels)
+        metrics.gauge("encoder_invalid_transitions_total", lambda: self.__decoder.invalid_transitions, "Encoder edges that skipped a state", metric_labels)
+
+        self.__thread = threading.Thread(target=self.__run, name=name, daemon=True)
+        self.__thread.start()
+
+        for pin in (self.__a.pin, self.__b.pin):
+            pin.edges = "both"
+        self.__a.pin.when_changed = self.__on_a_changed
+        self.__b.pin.when_changed = self.__on_b_changed
+
+    @property
+    def velocity(self) -> float:
+        return self.__velocity
+
+    def __on_a_changed(self, ticks, level) -> None:
+        self.__edges.append((ticks, time.perf_counter(), 0, level))
+        if not self.__pending.is_set():
+            self.__pending.set()
+
+    def __on_b_changed(self, ticks, level) -> None:
+        self.__edges.append((ticks, time.perf_counter(), 1, level))
+        if not self.__pending.is_set():
+            self.__pending.set()
+
+    def close(self) -> None:
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__a.pin.when_changed = None
+        self.__b.pin.when_changed = None
+        self.__pending.set()
+        if threading.current_thread() is not self.__thread:
+            self.__thread.join()
+        self.__a.close()
+        self.__b.close()
+
+    def __run(self) -> None:
+        while True:
+            self.__pending.wait()
+            if self.__closed:
+                return
+            # let the rest of this tick's edges arrive
+            time.sleep(self.TICK)
+            self.__pending.clear()
+            self.__process()
+
+    def __process(self) -> None:
+        if len(self.__edges) == self.RING_SIZE:
+            self.overflows += 1
+        try:
+            first_edge = self.__edges[0][1]
+        except IndexError:
+            return
+        delta = 0
+        count = 0
+        while True:
+            try:
+                ticks, _, pin, level = self.__edges.popleft()
+            except IndexError:
+                break
+            count += 1
+            detent = self.__decoder.feed(pin, int(level))
+            if detent != 0:
+                delta += detent
+                self.__update_velocity(ticks)
+        if count == 0:
+            return
+        self.edges_decoded += count
+        self.batches += 1
+        if delta != 0:
+            self.detents_decoded += abs(delta)
+            self.__on_rotated(delta, self.__velocity, first_edge)
+
+    def __update_velocity(self, ticks) -> None:
+        last = self.__last_detent
+        self.__last_detent = ticks
+        if last is None:
+            return
+        interval = self.__factory.ticks_diff(ticks, last)
+        if interval >= self.IDLE_TIME:
+            self.__velocity = 0.0
+        elif interval > 0:
+            rate = 1.0 / interval
+            if self.__velocity == 0.0:
+                self.__velocity = rate
+            else:
+                self.__velocity += (rate - self.__velocity) * self.VELOCITY_SMOOTHING
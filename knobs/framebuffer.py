@@ -0,0 +1,150 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Iterator, Optional
+if TYPE_CHECKING:
+    from knobs.i2cbus import I2CBusArbiter
+from contextlib import contextmanager
+
+from luma.core.device import device as luma_device
+from luma.oled.device import ssd1306
+import luma.oled.const
+
+from PIL import Image, ImageDraw
+import time
+from util.metrics import metrics
+
+class ShadowFramebuffer():
+    """
+    Keeps a copy of what was last pushed to a display and only transfers what changed.
+
+    SSD1306 RAM is organized in pages of 8 pixel rows, where every byte holds one
+    column of a page. For each page that differs from the shadow copy, only the
+    range of columns between the first and the last changed byte is written.
+    Frames identical to the last pushed frame are skipped entirely. Devices other
+    than the SSD1306 (e.g. luma's dummy device) receive whole frames, but
+    identical frames are still skipped.
+
+    With a bus arbiter, frames from canvas() and push() are queued on the arbiter,
+    which calls display() on its own thread. Without one they are transferred
+    directly on the calling thread.
+    """
+
+    def __init__(self, device: luma_device, metric_labels: Optional[dict[str, str]] = None, bus: Optional["I2CBusArbiter"] = None, name: str = ""):
+        """
+        :param bus: Arbiter of the I2C port the display is connected to.
+        :param name: Name of the display in the arbiter's metrics, e.g. its address.
+        """
+        self.__device = device
+        self.__bus = bus
+        self.__paged: bool = isinstance(device, ssd1306)
+        self.__pages: int = device.height // 8
+        self.__colstart: int = getattr(device, "_colstart", 0)
+        self.__shadow: Optional[list[bytes]] = None
+        self.__last_frame: Optional[bytes] = None
+
+        self.frames_pushed: int = 0
+        self.frames_skipped: int = 0
+        self.bytes_sent: int = 0
+
+        self.__push_time = metrics.histogram("display_push_seconds", "Time spent transferring a frame to the display", metric_labels)
+        metrics.gauge("display_frames_pushed_total", lambda: self.frames_pushed, "Frames transferred to the display", metric_labels)
+        metrics.gauge("display_frames_skipped_total", lambda: self.frames_skipped, "Frames identical to the displayed one", metric_labels)
+        metrics.gauge("display_bytes_total", lambda: self.bytes_sent, "Display RAM bytes transferred", metric_labels)
+
+        if self.__bus is not None:
+            self.__bus.add_display(self, name)
+
+    @property
+    def device(self) -> luma_device:
+        return self.__device
+
+    @property
+    def bus(self) -> Optional["I2CBusArbiter"]:
+        return self.__bus
+
+    @contextmanager
+    def canvas(self) -> Iterator[ImageDraw.ImageDraw]:
+        """
+        Drop-in replacement for luma's canvas(): yields a draw object for a blank
+        frame and pushes the frame when the block completes.
+        """
+        image = Image.new(self.__device.mode, self.__device.size)
+        yield ImageDraw.Draw(image)
+        self.push(image)
+
+    def push(self, image: Image.Image) -> None:
+        """
+        Queue the frame on the bus arbiter, or display it right away if there is none.
+        """
+        if self.__bus is not None:
+            self.__bus.submit(self, image)
+        else:
+            self.display(image)
+
+    def close(self) -> None:
+        if self.__bus is not None:
+            self.__bus.remove_display(self)
+
+    def display(self, image: Image.Image) -> None:
+        """
+        Transfer a frame to the display now, sending only the regions that changed.
+        Displays on a bus arbiter should be updated through push() instead.
+        :param image: Image in the device's mode and size.
+        """
+        push_start = time.perf_counter()
+        if not self.__paged:
+            frame = image.tobytes()
+            if frame == self.__last_frame:
+                self.frames_skipped += 1
+                return
+            self.__device.display(image)
+            self.__last_frame = frame
+            self.frames_pushed += 1
+            self.bytes_sent += len(frame)
+            self.__push_time.observe_since(push_start)
+            return
+
+        pages = self.__to_pages(self.__device.preprocess(image))
+        shadow = self.__shadow
+        pushed = False
+        for page, new in enumerate(pages):
+            if shadow is None:
+                start, end = 0, len(new) - 1
+            else:
+                diff = int.from_bytes(new, "big") ^ int.from_bytes(shadow[page], "big")
+                if diff == 0:
+                    continue
+                # the first byte is the most significant one
+                start = len(new) - 1 - (diff.bit_length() - 1) // 8
+                end = len(new) - 1 - ((diff & -diff).bit_length() - 1) // 8
+
+            self.__device.command(
+                luma.oled.const.ssd1306.COLUMNADDR, self.__colstart + start, self.__colstart + end,
+                luma.oled.const.ssd1306.PAGEADDR, page, page)
+            self.__device.data(list(new[start:end + 1]))
+            self.bytes_sent += end + 1 - start
+            pushed = True
+
+        self.__shadow = pages
+        if pushed:
+            self.frames_pushed += 1
+            self.__push_time.observe_since(push_start)
+        else:
+            self.frames_skipped += 1
+
+    def invalidate(self) -> None:
+        """
+        Forget the shadow copy so that the next frame is pushed in full,
+        e.g. after the display was cleared or reset externally.
+        """
+        self.__shadow = None
+        self.__last_frame = None
+
+    def __to_pages(self, image: Image.Image) -> list[bytes]:
+        # After flipping vertically and transposing, every row of the image holds one
+        # display column, bottom to top. Packed as 1-bit pixels (MSB first) this yields
+        # one byte per page and column with the topmost pixel in the LSB, which is the
+        # SSD1306 memory layout, with the pages in reverse order.
+        if image.mode != "1":
+            image = image.convert("1")
+        data = image.transpose(Image.Transpose.FLIP_TOP_BOTTOM).transpose(Image.Transpose.TRANSPOSE).tobytes()
+        return [data[self.__pages - 1 - page::self.__pages] for page in range(self.__pages)]
@@ -0,0 +1,212 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, Callable, Optional, TypeVar
+if TYPE_CHECKING:
+    from knobs.framebuffer import ShadowFramebuffer
+
+from concurrent.futures import Future
+from luma.core.interface.serial import i2c
+from PIL import Image
+import collections
+import threading
+import time
+from util.log import get_logger
+from util.metrics import metrics
+
+T = TypeVar("T")
+
+log = get_logger(__name__)
+
+class _BusDisplay():
+    __slots__ = ("image", "submitted", "last_input", "bus_time", "frames_merged", "queue_time")
+
+    def __init__(self, bus_time, frames_merged, queue_time):
+        self.image: Optional[Image.Image] = None
+        self.submitted: float = 0.0
+        self.last_input: float = 0.0
+        self.bus_time = bus_time
+        self.frames_merged = frames_merged
+        self.queue_time = queue_time
+
+class I2CBusArbiter():
+    """
+    Owns all transfers on one I2C port.
+
+    Displays sharing a port never talk to the bus themselves. They submit finished
+    frames, and a single thread per port transfers them one at a time. A display
+    has at most one pending frame: a newer frame replaces the one still waiting,
+    so a slow bus never transfers outdated content. When several displays have
+    frames waiting, the one that received input most recently (within
+    ACTIVE_INPUT_WINDOW) goes first, so the knob being turned stays responsive,
+    and the others are served in the order they started waiting.
+
+    Use for_port() to get the arbiter of a port, which is created on first use.
+    """
+    ACTIVE_INPUT_WINDOW = 0.5
+
+    __arbiters: dict[int, "I2CBusArbiter"] = {}
+    __arbiters_lock = threading.Lock()
+
+    @classmethod
+    def for_port(cls, port: int) -> "I2CBusArbiter":
+        with cls.__arbiters_lock:
+            arbiter = cls.__arbiters.get(port)
+            if arbiter is None:
+                arbiter = cls(port)
+                cls.__arbiters[port] = arbiter
+            return arbiter
+
+    def __init__(self, port: int):
+        self.__port = port
+        self.__metric_labels = {"port": str(port)}
+        self.__condition = threading.Condition()
+        self.__displays: dict["ShadowFramebuffer", _BusDisplay] = {}
+        self.__calls: collections.deque[tuple[Callable[[], Any], Future]] = collections.deque()
+        self.__closed: bool = False
+
+        self.__busy_time = metrics.counter("i2c_bus_busy_seconds_total", "Time the bus spent transferring", self.__metric_labels)
+
+        self.__thread = threading.Thread(target=self.__run, name=f"i2c-{port}", daemon=True)
+        self.__thread.start()
+
+    @property
+    def port(self) -> int:
+        return self.__port
+
+    def serial(self, address: int) -> i2c:
+        """
+        Open the serial interface of a device on this port. Its transfers must
+        happen on the bus thread, i.e. through call() or submitted frames.
+        """
+        return i2c(port=self.__port, address=address)
+
+    def call(self, function: Callable[[], T]) -> T:
+        """
+        Run a function on the bus thread ahead of any pending frames and return its
+        result, e.g. to initialize a display without racing other displays' frames.
+        """
+        if threading.current_thread() is self.__thread:
+            return function()
+        future: Future = Future()
+        with self.__condition:
+            if self.__closed:
+                raise RuntimeError(f"I2C bus {self.__port} is closed")
+            self.__calls.append((function, future))
+            self.__condition.notify()
+        return future.result()
+
+    def add_display(self, framebuffer: "ShadowFramebuffer", name: str) -> None:
+        labels = {**self.__metric_labels, "display": name}
+        display = _BusDisplay(
+            metrics.counter("i2c_display_bus_seconds_total", "Bus time spent transferring frames per display", labels),
+            metrics.counter("i2c_display_frames_merged_total", "Frames replaced by a newer frame before they were transferred", labels),
+            metrics.histogram("i2c_display_queue_seconds", "Time a frame waited for the bus", labels))
+        with self.__condition:
+            self.__displays[framebuffer] = display
+
+    def remove_display(self, framebuffer: "ShadowFramebuffer") -> None:
+        with self.__condition:
+            self.__displays.pop(framebuffer, None)
+
+    def submit(self, framebuffer: "ShadowFramebuffer", image: Image.Image) -> None:
+        """
+        Queue a frame for transfer. Thread-safe and non-blocking.
+        """
+        with self.__condition:
+            display = self.__displays.get(framebuffer)
+            if display is None:
+                # removed while a frame was being rendered
+                return
+            if display.image is not None:
+                display.frames_merged.inc()
+            else:
+                display.submitted = time.monotonic()
+            display.image = image
+            self.__condition.notify()
+
+    def input_received(self, framebuffer: "ShadowFramebuffer") -> None:
+        """
+        Give the display priority, as its knob is being used.
+        """
+        with self.__condition:
+            display = self.__displays.get(framebuffer)
+            if display is not None:
+                display.last_input = time.monotonic()
+
+    def bus_time(self, framebuffer: "ShadowFramebuffer") -> float:
+        """
+        :return: Seconds the bus spent transferring frames of the display.
+        """
+        return self.__displays[framebuffer].bus_time.value
+
+    def close(self) -> None:
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__condition.notify()
+        if threading.current_thread() is not self.__thread:
+            self.__thread.join()
+        with I2CBusArbiter.__arbiters_lock:
+            if I2CBusArbiter.__arbiters.get(self.__port) is self:
+                del I2CBusArbiter.__arbiters[self.__port]
+        for _, future in self.__calls:
+            future.set_exception(RuntimeError(f"I2C bus {self.__port} is closed"))
+
+    def __next_frame(self) -> Optional[tuple["ShadowFramebuffer", _BusDisplay, Image.Image, float]]:
+        now = time.monotonic()
+        best: Optional[tuple["ShadowFramebuffer", _BusDisplay]] = None
+        for framebuffer, display in self.__displays.items():
+            if display.image is None:
+                continue
+            if best is None:
+                best = (framebuffer, display)
+                continue
+            active = now - display.last_input < self.ACTIVE_INPUT_WINDOW
+            best_active = now - best[1].last_input < self.ACTIVE_INPUT_WINDOW
+            if active and (not best_active or display.last_input > best[1].last_input):
+                best = (framebuffer, display)
+            elif not active and not best_active and display.submitted < best[1].submitted:
+                best = (framebuffer, display)
+        if best is None:
+            return None
+        framebuffer, display = best
+        image = display.image
+        display.image = None
+        return framebuffer, display, image, display.submitted
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                while True:
+                    if self.__closed:
+                        return
+                    if len(self.__calls) > 0:
+                        call = self.__calls.popleft()
+                        frame = None
+                        break
+                    frame = self.__next_frame()
+                    if frame is not None:
+                        call = None
+                        break
+                    self.__condition.wait()
+
+            if call is not None:
+                function, future = call
+                try:
+                    future.set_result(function())
+                except Exception as e:
+                    future.set_exception(e)
+                continue
+
+            framebuffer, display, image, submitted = frame
+            display.queue_time.observe(time.monotonic() - submitted)
+            transfer_start = time.perf_counter()
+            try:
+                framebuffer.display(image)
+            except Exception as e:
+                log.error("display_transfer_failed", "Transfer to display failed", port=self.__port, error=str(e))
+                # the display's RAM is unknown now
+                framebuffer.invalidate()
+            elapsed = time.perf_counter() - transfer_start
+            display.bus_time.inc(elapsed)
+            self.__busy_time.inc(elapsed)
@@ -3,49 +3,164 @@ from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from knobs.knobmanager import KnobManager
 
-from luma.core.interface.serial import i2c
-from luma.oled.device import ssd1306
-from luma.core.render import canvas
-
-from gpiozero import RotaryEncoder, Button
+from luma.core.device import device as luma_device
 
 from pipedalclient.pedalboard import *
+from pipedalclient.client import ConnectionState
+from events import Subscription, SubscriptionGroup
+from typing import Optional
+from knobs.backends import InputBackend, GPIOInput, open_ssd1306
+from knobs.framebuffer import ShadowFramebuffer
+from knobs.i2cbus import I2CBusArbiter
+from knobs.menustrip import MenuStrip
+from knobs.rendercache import render_cache
+from knobs.renderscheduler import RenderScheduler
+from util.log import get_logger
+from util.metrics import metrics
 
-from PIL import ImageFont, ImageDraw
-import util
+from PIL import ImageDraw
 from enum import Enum
-import math
+import threading
 import time
 
+log = get_logger(__name__)
+
 class KnobMode(Enum):
     REGULAR = 0
     SELECT_ITEM = 1
     SELECT_CONTROL = 2
 
 class Knob():
+    MAX_FPS = 30
+    MENU_ANIMATION_DURATION = 0.1
+    # turning faster than this many detents per second accelerates value changes proportionally
+    ACCELERATION_START = 20.0
+    # at most this many steps per detent
+    ACCELERATION_MAX = 8.0
 
-    def __init__(self, knob_manager: "KnobManager", display_addr: int, rotary_pin1: int, rotary_pin2: int, push_pin: int):
+    def __init__(self, knob_manager: "KnobManager", display_addr: int, rotary_pin1: Optional[int] = None, rotary_pin2: Optional[int] = None, push_pin: Optional[int] = None, device: Optional[luma_device] = None, pin_factory = None, bus: Optional[I2CBusArbiter] = None, input: Optional[InputBackend] = None, name: Optional[str] = None):
+        """
+        :param device: Display to use instead of an SSD1306 at display_addr, e.g. a SimulatorDevice.
+        :param pin_factory: gpiozero pin factory for the encoder and button, e.g. a MockFactory.
+        :param bus: Arbiter of the I2C port the display is connected to, port 1 if not given. Not used with a custom device unless given.
+        :param input: Input to use instead of the encoder and button on the given pins, e.g. a ScriptedInput.
+        :param name: Name of the knob in metrics and thread names, the display address if not given.
+        """
+        if name is None:
+            name = f"{display_addr:#x}"
         self.__knob_manager = knob_manager
+        self.__closed: bool = False
 
-        self.__display_serial: i2c = i2c(port=1, address=display_addr)
-        self.__display: ssd1306 = ssd1306(self.__display_serial, rotate=0)
+        if device is None:
+            if bus is None:
+                bus = I2CBusArbiter.for_port(1)
+            device = open_ssd1306(bus, display_addr)
+        self.__display: luma_device = device
+        self.__bus: Optional[I2CBusArbiter] = bus
+        metric_labels = {"display": name}
+        self.__framebuffer: ShadowFramebuffer = ShadowFramebuffer(self.__display, metric_labels, bus, name=name)
+        self.__input_time = metrics.histogram("knob_input_to_model_seconds", "Time from the first encoder edge of a batch to the model update", metric_labels)
 
-        self.__rotary_encoder: RotaryEncoder = RotaryEncoder(rotary_pin1, rotary_pin2)
-        self.__rotary_encoder.when_rotated_clockwise = lambda x: self.__on_rotary_change(x, 1)
-        self.__rotary_encoder.when_rotated_counter_clockwise = lambda x: self.__on_rotary_change(x, -1)
+        if input is None:
+            input = GPIOInput(rotary_pin1, rotary_pin2, push_pin, pin_factory, name=f"encoder-{name}", metric_labels=metric_labels)
+        self.__input: InputBackend = input
+        self.__input.when_rotated = self.__on_rotary_change
+        self.__input.when_pressed = self.__on_button_press
+        self.__input.when_held = self.__on_button_hold
 
-        self.__button: Button = Button(pin=push_pin, bounce_time = 0.05)
-        self.__button.when_activated = self.__on_button_press
-        self.__button.hold_time = 3
-        self.__button.when_held = self.__on_button_hold
-        
         self.__mode: KnobMode = KnobMode.REGULAR
 
+        # animated scroll position of the circle menu, in items
+        self.__menu_lock = threading.Lock()
+        self.__menu_from: float = 0.0
+        self.__menu_target: float = 0.0
+        self.__menu_start: float = 0.0
+
+        self.__render_scheduler: RenderScheduler = RenderScheduler(self.render, self.MAX_FPS, name=f"render-{name}", metric_labels=metric_labels)
+
+        # subscriptions for the lifetime of the knob, and for the current selection
+        self.__subscriptions = SubscriptionGroup()
+        self.__subscriptions.add(self.__knob_manager.pedal_client.on_connection_state_changed.add_listener(self.__on_connection_state_changed))
+        self.__pedalboard_subscription: Optional[Subscription] = None
+        self.__item_subscription: Optional[Subscription] = None
+        self.__control_subscription: Optional[Subscription] = None
+
+        # menus for the current items and the controls of the selected item
+        self.__item_menu: Optional[MenuStrip] = None
+        self.__control_menu: Optional[MenuStrip] = None
+
+        self.__pedalboard: Optional[Pedalboard] = None
+        self.__selected_pedalboard_item: Optional[PedalboardItem] = None
+        self.__selected_control: Optional[PedalboardItemControl] = None
         if self.__knob_manager.pedal_client.pedalboard is not None:
-            self.__selected_pedalboard_item: PedalboardItem = self.__knob_manager.pedal_client.pedalboard.items[0]
-            self.__selected_control: PedalboardItemControl = self.__selected_pedalboard_item.controls[0]
-            self.__selected_control.on_value_changed.add_listener(self.__on_selected_control_value_changed)
-            self.__display_draw_regular()
+            self.attach(self.__knob_manager.pedal_client.pedalboard)
+
+        self.__input.start()
+
+    def attach(self, pedalboard: Pedalboard) -> None:
+        """
+        Show the given pedalboard, selecting its first item and control.
+        """
+        if self.__pedalboard_subscription is not None:
+            self.__pedalboard_subscription.close()
+        self.__pedalboard = pedalboard
+        self.__pedalboard_subscription = pedalboard.on_items_changed.add_listener(self.__on_items_changed)
+        self.__item_menu = MenuStrip([x.plugin_name for x in pedalboard.items])
+        self.__select_item(pedalboard.items[0] if len(pedalboard.items) > 0 else None)
+        self.mode = KnobMode.REGULAR
+
+    def __on_connection_state_changed(self, state: ConnectionState) -> None:
+        self.__render_scheduler.invalidate()
+
+    def __on_items_changed(self, pedalboard: Pedalboard) -> None:
+        self.__item_menu = MenuStrip([x.plugin_name for x in pedalboard.items])
+        # keep the selection unless the selected item is gone
+        if self.__selected_pedalboard_item not in pedalboard:
+            self.__select_item(pedalboard.items[0] if len(pedalboard.items) > 0 else None)
+        self.mode = self.__mode
+
+    def __on_controls_changed(self, item: PedalboardItem) -> None:
+        self.__control_menu = MenuStrip([x.symbol for x in item.controls])
+        if self.__selected_control not in item:
+            self.selected_control = item.controls[0] if len(item.controls) > 0 else None
+        self.mode = self.__mode
+
+    def __select_item(self, item: Optional[PedalboardItem]) -> None:
+        if self.__item_subscription is not None:
+            self.__item_subscription.close()
+            self.__item_subscription = None
+        self.__selected_pedalboard_item = item
+        self.__control_menu = MenuStrip([x.symbol for x in item.controls]) if item is not None else None
+        if item is not None:
+            self.__item_subscription = item.on_controls_changed.add_listener(self.__on_controls_changed)
+        self.selected_control = item.controls[0] if item is not None and len(item.controls) > 0 else None
+
+    @property
+    def selection(self) -> Optional[tuple[int, str]]:
+        """
+        instanceId of the selected item and symbol of the selected control.
+        """
+        item = self.__selected_pedalboard_item
+        control = self.__selected_control
+        if item is None or control is None:
+            return None
+        return item.instance_id, control.symbol
+
+    def restore_selection(self, instance_id: int, symbol: str) -> bool:
+        """
+        Select the given item and control of the attached pedalboard, e.g. as saved in a snapshot.
+        :return: Whether the item and control exist.
+        """
+        if self.__pedalboard is None:
+            return False
+        try:
+            item = self.__pedalboard.item(instance_id)
+            control = item.control(symbol)
+        except KeyError:
+            return False
+        self.__select_item(item)
+        self.selected_control = control
+        return True
 
     @property
     def mode(self) -> KnobMode:
@@ -53,53 +168,84 @@ class Knob():
     
     @mode.setter
     def mode(self, value: KnobMode) -> None:
+        if value == KnobMode.SELECT_ITEM and self.__selected_pedalboard_item is not None:
+            self.__jump_menu_to(self.__selected_pedalboard_item.pedalboard.index_of_item(self.__selected_pedalboard_item))
+        elif value == KnobMode.SELECT_CONTROL and self.__selected_control is not None:
+            self.__jump_menu_to(self.__selected_pedalboard_item.index_of_control(self.__selected_control))
         self.__mode = value
-        if self.__mode == KnobMode.REGULAR:
-            self.__display_draw_regular()
-        elif self.__mode == KnobMode.SELECT_ITEM:
-            self.__display_draw_select_item()
-        elif self.__mode == KnobMode.SELECT_CONTROL:
-            self.__display_draw_select_control()
+        self.__render_scheduler.invalidate()
 
     @property
-    def selected_control(self) -> PedalboardItemControl:
+    def selected_control(self) -> Optional[PedalboardItemControl]:
         return self.__selected_control
     
     @selected_control.setter
-    def selected_control(self, control: PedalboardItemControl) -> None:
-        self.__selected_control.on_value_changed.remove_listener(self.__on_selected_control_value_changed)
+    def selected_control(self, control: Optional[PedalboardItemControl]) -> None:
+        if self.__control_subscription is not None:
+            self.__control_subscription.close()
+            self.__control_subscription = None
         self.__selected_control = control
-        self.__selected_control.on_value_changed.add_listener(self.__on_selected_control_value_changed)
+        if control is not None:
+            self.__control_subscription = control.on_value_changed.add_listener(self.__on_selected_control_value_changed)
+        self.__render_scheduler.invalidate()
         
     def __on_selected_control_value_changed(self, value: float):
-        self.__display_draw_regular()
+        self.__render_scheduler.invalidate()
+
+    def __accelerate(self, delta: int, velocity: float) -> int:
+        factor = min(max(velocity / self.ACCELERATION_START, 1.0), self.ACCELERATION_MAX)
+        steps = round(delta * factor)
+        return steps if steps != 0 else delta
+
+    def __on_rotary_change(self, delta: int, velocity: float, start: float) -> None:
+        """
+        :param delta: Detents turned since the last call, positive clockwise.
+        :param velocity: Turning speed in detents per second.
+        :param start: time.perf_counter() time of the first detent's edge, for knob_input_to_model_seconds.
+        """
+        if self.__bus is not None:
+            self.__bus.input_received(self.__framebuffer)
+        if self.__selected_control is None or delta == 0:
+            return
 
-    def __on_rotary_change(self, rotary_encoder: RotaryEncoder, direction: int) -> None:
         if self.mode == KnobMode.REGULAR:
-            self.__selected_control.value = round(self.__selected_control.value + direction * 0.05, 3)
-            self.__display_draw_regular()
+            # the whole batch is one model update, so one message to the server
+            control = self.__selected_control
+            steps = self.__accelerate(delta, velocity)
+            port = control.port
+            if port is not None:
+                control.value = port.step(control.value, steps)
+            else:
+                # no metadata (yet), the range is unknown
+                control.value = round(control.value + steps * 0.05, 3)
+            self.__input_time.observe_since(start)
 
         elif self.mode == KnobMode.SELECT_ITEM:
-            new_item: Optional[PedalboardItem] = None
-            if direction > 0:
-                new_item = self.__selected_pedalboard_item.pedalboard.next_item(self.__selected_pedalboard_item)
-            elif direction < 0:
-                new_item = self.__selected_pedalboard_item.pedalboard.previous_item(self.__selected_pedalboard_item)
-            if new_item is not None:
-                self.select_item_animated(new_item)
-                self.selected_control = self.__selected_pedalboard_item.controls[0]
+            pedalboard = self.__selected_pedalboard_item.pedalboard
+            item = self.__selected_pedalboard_item
+            for i in range(abs(delta)):
+                new_item = pedalboard.next_item(item) if delta > 0 else pedalboard.previous_item(item)
+                if new_item is None:
+                    break
+                item = new_item
+            if item is not self.__selected_pedalboard_item:
+                self.select_item_animated(item)
 
         elif self.mode == KnobMode.SELECT_CONTROL:
-            new_control: Optional[PedalboardItemControl] = None
-            if direction > 0:
-                new_control = self.__selected_pedalboard_item.next_control(self.__selected_control)
-            elif direction < 0:
-                new_control = self.__selected_pedalboard_item.previous_control(self.__selected_control)
-            if new_control is not None:
-                self.select_control_animated(new_control)
+            pedalboard_item = self.__selected_pedalboard_item
+            control = self.__selected_control
+            for i in range(abs(delta)):
+                new_control = pedalboard_item.next_control(control) if delta > 0 else pedalboard_item.previous_control(control)
+                if new_control is None:
+                    break
+                control = new_control
+            if control is not self.__selected_control:
+                self.select_control_animated(control)
         
 
-    def __on_button_press(self, button: Button) -> None:
+    def __on_button_press(self) -> None:
+        if self.__bus is not None:
+            self.__bus.input_received(self.__framebuffer)
         if self.mode == KnobMode.REGULAR:
             pass
         elif self.mode == KnobMode.SELECT_ITEM:
@@ -107,80 +253,104 @@ class Knob():
         elif self.mode == KnobMode.SELECT_CONTROL:
             self.mode = KnobMode.REGULAR
 
-    def __on_button_hold(self, button: Button) -> None:
-        print("hold")
+    def __on_button_hold(self) -> None:
+        log.debug("button_held", "Button held", mode=self.mode.name)
         if self.mode == KnobMode.REGULAR:
             self.mode = KnobMode.SELECT_ITEM
-    
-    def __display_draw_regular(self):
-        with canvas(self.__display) as draw:
-            draw.text((64, 0), self.__selected_pedalboard_item.plugin_name, fill="white", font=ImageFont.truetype(util.FONT_PATH_SANS, 10), anchor="ma")
-            draw.text((64, 10), self.__selected_control.symbol, fill="white", font=ImageFont.truetype(util.FONT_PATH_SANS, 20), anchor="ma")
-            draw.text((64, 64), str(self.__selected_control.value), fill="white", font=ImageFont.truetype(util.FONT_PATH_SANS, 32), anchor="md")
-
-    def __display_draw_select_item(self):
-        all_items = self.__selected_pedalboard_item.pedalboard.items
-        self.__draw_circle_menu([x.plugin_name for x in all_items], all_items.index(self.__selected_pedalboard_item))
 
     def select_item_animated(self, new_item: PedalboardItem) -> None:
-        all_items = self.__selected_pedalboard_item.pedalboard.items
-
-        ANIM_FRAMES = 3
-        for i in range(ANIM_FRAMES):
-            if all_items.index(new_item) - all_items.index(self.__selected_pedalboard_item) > 0:
-                # forward
-                self.__draw_circle_menu([x.plugin_name for x in all_items], all_items.index(new_item) - 1 + i / ANIM_FRAMES)
-            elif all_items.index(new_item) - all_items.index(self.__selected_pedalboard_item) < 0:
-                # backward
-                self.__draw_circle_menu([x.plugin_name for x in all_items], all_items.index(new_item) + 1 - i / ANIM_FRAMES)
-            else:
-                break
-        self.__draw_circle_menu([x.plugin_name for x in all_items], all_items.index(new_item))
-        self.__selected_pedalboard_item = new_item
-
-    def __display_draw_select_control(self):
-        all_controls = self.__selected_pedalboard_item.controls
-        self.__draw_circle_menu([x.symbol for x in all_controls], all_controls.index(self.__selected_control))
+        self.__animate_menu_to(self.__selected_pedalboard_item.pedalboard.index_of_item(new_item))
+        self.__select_item(new_item)
 
     def select_control_animated(self, new_control: PedalboardItemControl) -> None:
-        all_controls = self.__selected_pedalboard_item.controls
-
-        ANIM_FRAMES = 3
-        for i in range(ANIM_FRAMES):
-            if all_controls.index(new_control) - all_controls.index(self.__selected_control) > 0:
-                # forward
-                self.__draw_circle_menu([x.symbol for x in all_controls], all_controls.index(new_control) - 1 + i / ANIM_FRAMES)
-            elif all_controls.index(new_control) - all_controls.index(self.__selected_control) < 0:
-                # backward
-                self.__draw_circle_menu([x.symbol for x in all_controls], all_controls.index(new_control) + 1 - i / ANIM_FRAMES)
-            else:
-                break
-        self.__draw_circle_menu([x.symbol for x in all_controls], all_controls.index(new_control))
+        self.__animate_menu_to(self.__selected_pedalboard_item.index_of_control(new_control))
         self.selected_control = new_control
 
-    def __draw_circle_menu(self, items: list[str], selected_item: float) -> None:
-        with canvas(self.__display) as draw:
-            draw.line((13, 32, 16, 32), fill="white")
+    def __jump_menu_to(self, position: float) -> None:
+        with self.__menu_lock:
+            self.__menu_from = position
+            self.__menu_target = position
+            self.__menu_start = 0.0
+
+    def __animate_menu_to(self, position: float) -> None:
+        # starting from wherever the menu currently is makes the animation interruptible by new input
+        now = time.monotonic()
+        with self.__menu_lock:
+            self.__menu_from = self.__menu_position(now)
+            self.__menu_target = position
+            self.__menu_start = now
+        self.__render_scheduler.invalidate()
 
-            DISPLAYED_ITEMS = 7
-            decimals = selected_item % 1
-            index_offset = int(selected_item) - DISPLAYED_ITEMS // 2
-            for i in range(0, DISPLAYED_ITEMS):
-                if index_offset + i < 0 or index_offset + i >= len(items):
-                    continue
+    def __menu_position(self, now: float) -> float:
+        progress = (now - self.__menu_start) / self.MENU_ANIMATION_DURATION
+        if progress >= 1:
+            return self.__menu_target
+        return self.__menu_from + (self.__menu_target - self.__menu_from) * progress
 
-                alpha = -math.pi / 2 + ((i + 1 - decimals) * math.pi / (DISPLAYED_ITEMS + 1))
-                x = -20 + math.cos(alpha) * 40
-                y = 32 + math.sin(alpha) * 40
+    def render(self, now: float) -> bool:
+        """
+        Render the current state to the display. Called by the render scheduler,
+        but may be called directly, e.g. for benchmarking.
+        :param now: Current time as returned by time.monotonic(), used for animations.
+        :return: Whether an animation is in progress.
+        """
+        # the selection may be changed by other threads while rendering
+        item = self.__selected_pedalboard_item
+        control = self.__selected_control
+        if item is None or control is None:
+            with self.__framebuffer.canvas():
+                pass
+            return False
 
-                font_size = -8 * math.pow(alpha, 2) + 12
-                if font_size < 0:
-                    continue
-                draw.text((x, y), items[index_offset + i], fill="white", font=ImageFont.truetype(util.FONT_PATH_SANS, font_size), anchor="lm")
+        mode = self.__mode
+        if mode == KnobMode.REGULAR:
+            self.__display_draw_regular(item, control)
+            return False
+
+        with self.__menu_lock:
+            position = self.__menu_position(now)
+            animating = position != self.__menu_target
+        if mode == KnobMode.SELECT_ITEM:
+            self.__draw_circle_menu(self.__item_menu, position)
+        elif mode == KnobMode.SELECT_CONTROL:
+            self.__draw_circle_menu(self.__control_menu, position)
+        return animating
+    
+    def __display_draw_regular(self, item: PedalboardItem, control: PedalboardItemControl):
+        with self.__framebuffer.canvas() as draw:
+            render_cache.text(draw, (64, 0), item.plugin_name, 10, anchor="ma")
+            render_cache.text(draw, (64, 10), control.symbol, 20, anchor="ma")
+            port = control.port
+            # values from steps and the server's float32 values are not round
+            value = port.format(control.value) if port is not None else str(round(control.value, 3))
+            render_cache.text(draw, (64, 64), value, 32, anchor="md")
+            self.__draw_connection_state(draw)
+
+    def __draw_connection_state(self, draw: ImageDraw.ImageDraw) -> None:
+        state = self.__knob_manager.pedal_client.connection_state
+        if state == ConnectionState.CONNECTING:
+            draw.ellipse((122, 0, 127, 5), outline="white")
+        elif state == ConnectionState.DISCONNECTED:
+            draw.ellipse((122, 0, 127, 5), fill="white")
+
+    def __draw_circle_menu(self, menu: Optional[MenuStrip], position: float) -> None:
+        with self.__framebuffer.canvas() as draw:
+            draw.line((13, 32, 16, 32), fill="white")
+            self.__draw_connection_state(draw)
+            if menu is not None:
+                menu.draw(draw, position)
 
     def close(self):
-        self.__rotary_encoder.close()
-        self.__button.close()
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__subscriptions.close()
+        for subscription in (self.__pedalboard_subscription, self.__item_subscription, self.__control_subscription):
+            if subscription is not None:
+                subscription.close()
+        self.__render_scheduler.close()
+        self.__framebuffer.close()
+        self.__input.close()
 
     def __del__(self):
         self.close()
\ No newline at end of file
@@ -1,31 +1,97 @@
 from knobs.knob import Knob
-from pipedalclient import PiPedalClient
+from knobs.backends import create_display, create_input
+from pipedalclient import PiPedalClient, Pedalboard
 from typing import Optional
 import yaml
 
+def knob_name(display_addr: int, i2c_port: int = 1) -> str:
+    """
+    Name of a knob in snapshots and metrics. Knobs on port 1 are named by their
+    display address alone, as before there were several ports.
+    """
+    if i2c_port == 1:
+        return f"{display_addr:#x}"
+    return f"{i2c_port}-{display_addr:#x}"
+
 class KnobManager():
-    def __init__(self, pedal_client: PiPedalClient):
+    def __init__(self, pedal_client: PiPedalClient, knob_configs: Optional[list[dict]] = None, backend_config: Optional[dict] = None):
+        """
+        :param knob_configs: Knobs connected to pedal_client's server, the knobs of config.yml if not given.
+        :param backend_config: Display and input backends, the backend of config.yml if not given.
+        """
         self.pedal_client: PiPedalClient = pedal_client
-        self.pedal_client.on_pedalboard_changed.add_listener(lambda pb: self.__init_knobs())
-        self.pedal_client.send_current_pedalboard()
+        self.__pedalboard_subscription = self.pedal_client.on_pedalboard_changed.add_listener(self.__on_pedalboard_changed)
 
-        with open("config.yml", "r") as f:
-            config = yaml.safe_load(f)
-            self.__knob_configs = config["knobs"]
+        if knob_configs is None or backend_config is None:
+            with open("config.yml", "r") as f:
+                config = yaml.safe_load(f)
+            if knob_configs is None:
+                knob_configs = config["knobs"]
+            if backend_config is None:
+                backend_config = config.get("backend") or {}
+        self.__knob_configs: list[dict] = knob_configs
+        self.__backend_config: dict = backend_config
         
         self.__knobs: list[Knob] = []
+        self.__knob_names: list[str] = []
         self.__init_knobs()
         
-    def __init_knobs(self) -> None:
+    def __on_pedalboard_changed(self, pedalboard: Pedalboard) -> None:
         for knob in self.__knobs:
-            knob.close()
-        self.__knobs: list[Knob] = []
+            knob.attach(pedalboard)
+
+    def __init_knobs(self) -> None:
         for knob_config in self.__knob_configs:
+            display_addr = int(knob_config["display_addr"])
+            i2c_port = int(knob_config.get("i2c_port", 1))
+            name = knob_name(display_addr, i2c_port)
+            device, bus = create_display(self.__backend_config, display_addr, i2c_port)
             knob = Knob(
                 self,
-                display_addr=int(knob_config["display_addr"]),
-                rotary_pin1=knob_config["rotary_pin1"],
-                rotary_pin2=knob_config["rotary_pin2"],
-                push_pin=knob_config["push_pin"]
+                display_addr=display_addr,
+                device=device,
+                bus=bus,
+                input=create_input(self.__backend_config, knob_config, name),
+                name=name
             )
             self.__knobs.append(knob)
+            self.__knob_names.append(name)
+
+    def snapshot(self) -> Optional[dict]:
+        """
+        The pedalboard and the selection of every knob, for a warm start with restore().
+        """
+        pedalboard = self.pedal_client.pedalboard
+        if pedalboard is None:
+            return None
+        selections = {}
+        for name, knob in zip(self.__knob_names, self.__knobs):
+            selection = knob.selection
+            if selection is not None:
+                selections[name] = {"instanceId": selection[0], "symbol": selection[1]}
+        return {
+            "server": self.pedal_client.url,
+            "pedalboard": pedalboard.to_json(),
+            "knobs": selections,
+        }
+
+    def restore(self, snapshot: dict) -> None:
+        """
+        Show the pedalboard and selections of a snapshot until the server's
+        current pedalboard arrives. Selections of items and controls that no
+        longer exist are skipped.
+        """
+        if snapshot.get("server") != self.pedal_client.url:
+            return
+        self.pedal_client.restore_pedalboard(snapshot["pedalboard"])
+        selections = snapshot.get("knobs", {})
+        for name, knob in zip(self.__knob_names, self.__knobs):
+            selection = selections.get(name)
+            if selection is not None:
+                knob.restore_selection(selection["instanceId"], selection["symbol"])
+
+    def close(self) -> None:
+        self.__pedalboard_subscription.close()
+        for knob in self.__knobs:
+            knob.close()
+        self.__knobs = []
@@ -0,0 +1,91 @@
+from __future__ import annotations
+from typing import Optional
+import math
+
+from PIL import Image, ImageDraw
+from knobs.rendercache import RenderCache, render_cache
+
+class MenuLayout():
+    """
+    Precomputed layout of the circle menu.
+
+    The labels of the menu sit on a circle left of the display. Where a label is
+    drawn and how large only depends on its slot and on the fractional part of
+    the scroll position, so the layout is computed once for STEPS positions
+    between two items, with coordinates rounded to pixels and font sizes
+    quantized like the render cache does.
+    """
+    DISPLAYED_ITEMS = 7
+    STEPS = 64
+
+    def __init__(self):
+        self.__positions: list[tuple[tuple[int, int, int, float], ...]] = [self.__compute(step / self.STEPS) for step in range(self.STEPS)]
+
+    def __compute(self, decimals: float) -> tuple[tuple[int, int, int, float], ...]:
+        slots = []
+        for i in range(self.DISPLAYED_ITEMS):
+            alpha = -math.pi / 2 + ((i + 1 - decimals) * math.pi / (self.DISPLAYED_ITEMS + 1))
+            font_size = -8 * math.pow(alpha, 2) + 12
+            if font_size < 0:
+                continue
+            x = -20 + math.cos(alpha) * 40
+            y = 32 + math.sin(alpha) * 40
+            slots.append((i, round(x), round(y), RenderCache.quantize(font_size)))
+        return tuple(slots)
+
+    def slots(self, position: float) -> tuple[int, tuple[tuple[int, int, int, float], ...]]:
+        """
+        :param position: Scroll position of the menu, in items.
+        :return: Index of the item in the first slot, and (slot, x, y, font size) of each visible slot.
+        """
+        first = math.floor(position)
+        step = round((position - first) * self.STEPS)
+        if step == self.STEPS:
+            first += 1
+            step = 0
+        return first - self.DISPLAYED_ITEMS // 2, self.__positions[step]
+
+
+menu_layout: MenuLayout = MenuLayout()
+
+
+class MenuStrip():
+    """
+    Circle menu for a fixed list of labels.
+
+    Labels are rasterized once per font size the layout uses and kept for the
+    lifetime of the strip, so animation frames only blit cached bitmaps at
+    precomputed positions. Create a new strip when the labels change.
+    """
+
+    def __init__(self, labels: list[str], cache: RenderCache = render_cache, layout: MenuLayout = menu_layout):
+        self.__labels: tuple[str, ...] = tuple(labels)
+        self.__cache = cache
+        self.__layout = layout
+        self.__sprites: dict[tuple[int, float], tuple[Optional[Image.Image], int, int]] = {}
+
+    @property
+    def labels(self) -> tuple[str, ...]:
+        return self.__labels
+
+    def __len__(self) -> int:
+        return len(self.__labels)
+
+    def draw(self, draw: ImageDraw.ImageDraw, position: float, fill="white") -> None:
+        """
+        Draw the menu scrolled to the given position.
+        :param position: Scroll position in items, fractional while animating.
+        """
+        first, slots = self.__layout.slots(position)
+        for slot, x, y, size in slots:
+            index = first + slot
+            if index < 0 or index >= len(self.__labels):
+                continue
+            key = (index, size)
+            sprite = self.__sprites.get(key)
+            if sprite is None:
+                sprite = self.__cache.sprite(self.__labels[index], size, anchor="lm")
+                self.__sprites[key] = sprite
+            image, offset_x, offset_y = sprite
+            if image is not None:
+                draw.bitmap((x + offset_x, y + offset_y), image, fill=fill)
@@ -0,0 +1,127 @@
+from __future__ import annotations
+from typing import Optional
+from collections import OrderedDict
+import threading
+
+from PIL import Image, ImageDraw, ImageFont
+import util
+from util.metrics import metrics
+
+class RenderCache():
+    """
+    Shared LRU cache for loaded fonts and pre-rasterized text.
+
+    Fonts are keyed by their size quantized to SIZE_QUANTUM, so the fractional
+    sizes used by menu animations map onto a small set of fonts. Text is rendered
+    once per (text, size, anchor) into a 1-bit sprite which later draws are
+    blitted from, instead of loading the font and rasterizing the glyphs again.
+    Both caches are bounded and evict the least recently used entry.
+    """
+
+    SIZE_QUANTUM = 0.5
+
+    def __init__(self, font_path: str = util.FONT_PATH_SANS, max_fonts: int = 32, max_sprites: int = 512):
+        self.__font_path = font_path
+        self.__max_fonts = max_fonts
+        self.__max_sprites = max_sprites
+        self.__fonts: OrderedDict[float, ImageFont.FreeTypeFont] = OrderedDict()
+        self.__sprites: OrderedDict[tuple[str, float, str], tuple[Optional[Image.Image], int, int]] = OrderedDict()
+        self.__lock = threading.Lock()
+
+        self.font_hits: int = 0
+        self.font_misses: int = 0
+        self.sprite_hits: int = 0
+        self.sprite_misses: int = 0
+        self.evictions: int = 0
+
+        for name in ("font_hits", "font_misses", "sprite_hits", "sprite_misses", "evictions"):
+            metrics.gauge(f"render_cache_{name}_total", lambda name=name: getattr(self, name), f"Render cache {name.replace('_', ' ')}")
+
+    @classmethod
+    def quantize(cls, size: float) -> float:
+        return round(size / cls.SIZE_QUANTUM) * cls.SIZE_QUANTUM
+
+    def font(self, size: float) -> ImageFont.FreeTypeFont:
+        """
+        Get the font in the given size, loading it if it is not cached yet.
+        :param size: Font size, quantized to SIZE_QUANTUM.
+        """
+        size = max(self.quantize(size), self.SIZE_QUANTUM)
+        with self.__lock:
+            font = self.__fonts.get(size)
+            if font is not None:
+                self.__fonts.move_to_end(size)
+                self.font_hits += 1
+                return font
+            self.font_misses += 1
+
+        font = ImageFont.truetype(self.__font_path, size)
+        with self.__lock:
+            self.__fonts[size] = font
+            while len(self.__fonts) > self.__max_fonts:
+                self.__fonts.popitem(last=False)
+                self.evictions += 1
+        return font
+
+    def text(self, draw: ImageDraw.ImageDraw, xy: tuple[float, float], text: str, size: float, anchor: str = "la", fill="white") -> None:
+        """
+        Draw text like ImageDraw.text() does, but from a cached sprite.
+        :param draw: Draw object of the target image.
+        :param xy: Anchor position of the text.
+        :param text: Text to draw.
+        :param size: Font size, quantized to SIZE_QUANTUM.
+        :param anchor: PIL text anchor.
+        :param fill: Color to draw the text in.
+        """
+        sprite, offset_x, offset_y = self.sprite(text, size, anchor)
+        if sprite is not None:
+            draw.bitmap((round(xy[0]) + offset_x, round(xy[1]) + offset_y), sprite, fill=fill)
+
+    def sprite(self, text: str, size: float, anchor: str = "la") -> tuple[Optional[Image.Image], int, int]:
+        """
+        Get the rasterized text and its offset relative to the anchor point.
+        The sprite is None for text without any visible pixels.
+        """
+        key = (text, self.quantize(size), anchor)
+        with self.__lock:
+            entry = self.__sprites.get(key)
+            if entry is not None:
+                self.__sprites.move_to_end(key)
+                self.sprite_hits += 1
+                return entry
+            self.sprite_misses += 1
+
+        font = self.font(size)
+        left, top, right, bottom = font.getbbox(text, anchor=anchor)
+        if right <= left or bottom <= top:
+            entry = (None, 0, 0)
+        else:
+            sprite = Image.new("1", (right - left, bottom - top))
+            ImageDraw.Draw(sprite).text((-left, -top), text, fill=1, font=font, anchor=anchor)
+            entry = (sprite, left, top)
+
+        with self.__lock:
+            self.__sprites[key] = entry
+            while len(self.__sprites) > self.__max_sprites:
+                self.__sprites.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__fonts.clear()
+            self.__sprites.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "font_hits": self.font_hits,
+            "font_misses": self.font_misses,
+            "sprite_hits": self.sprite_hits,
+            "sprite_misses": self.sprite_misses,
+            "evictions": self.evictions,
+            "fonts": len(self.__fonts),
+            "sprites": len(self.__sprites),
+        }
+
+
+render_cache: RenderCache = RenderCache()
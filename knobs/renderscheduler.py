@@ -0,0 +1,93 @@
+from __future__ import annotations
+from typing import Callable, Optional
+import threading
+import time
+from util.log import get_logger
+from util.metrics import metrics
+
+log = get_logger(__name__)
+
+class RenderScheduler():
+    """
+    Renders a display on its own thread at a capped frame rate.
+
+    Callers never draw themselves. They change the state the display should show
+    and call invalidate(), which only flags the display as dirty and returns
+    immediately, so input and network handlers are never blocked by rendering.
+    The render thread wakes up, waits until the frame interval has passed and
+    renders whatever the state is at that point, so any number of updates
+    between two frames collapse into a single frame showing the latest state.
+
+    The render callback receives the current time (time.monotonic()) and returns
+    True while it is animating, in which case another frame is scheduled.
+    """
+
+    def __init__(self, render: Callable[[float], bool], max_fps: float = 30.0, name: Optional[str] = None, metric_labels: Optional[dict[str, str]] = None):
+        self.__render = render
+        self.__min_interval: float = 1.0 / max_fps
+        self.__condition = threading.Condition()
+        self.__dirty: bool = False
+        self.__closed: bool = False
+
+        self.frames_rendered: int = 0
+        self.frames_dropped: int = 0
+
+        self.__render_time = metrics.histogram("render_seconds", "Time spent rendering and pushing a frame", metric_labels)
+        metrics.gauge("render_frames_total", lambda: self.frames_rendered, "Frames rendered", metric_labels)
+        metrics.gauge("render_frames_dropped_total", lambda: self.frames_dropped, "Display updates merged into a later frame", metric_labels)
+
+        self.__thread = threading.Thread(target=self.__run, name=name, daemon=True)
+        self.__thread.start()
+
+    def invalidate(self) -> None:
+        """
+        Request a new frame. Thread-safe and non-blocking.
+        """
+        with self.__condition:
+            if self.__dirty:
+                # merged into the frame that is already pending
+                self.frames_dropped += 1
+            self.__dirty = True
+            self.__condition.notify()
+
+    def close(self) -> None:
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__condition.notify()
+        if threading.current_thread() is not self.__thread:
+            self.__thread.join()
+
+    def __run(self) -> None:
+        last_frame = 0.0
+        while True:
+            with self.__condition:
+                while not self.__dirty and not self.__closed:
+                    self.__condition.wait()
+                if self.__closed:
+                    return
+
+            wait = last_frame + self.__min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+            with self.__condition:
+                if self.__closed:
+                    return
+                # cleared before rendering, so updates arriving during the render cause another frame
+                self.__dirty = False
+
+            last_frame = time.monotonic()
+            render_start = time.perf_counter()
+            try:
+                animating = self.__render(last_frame)
+            except Exception as e:
+                log.exception("render_failed", "Render failed")
+                animating = False
+            self.__render_time.observe_since(render_start)
+            self.frames_rendered += 1
+
+            if animating:
+                with self.__condition:
+                    self.__dirty = True
@@ -1,23 +1,213 @@
 import asyncio
-from knobs import *
-from typing import Optional
+import importlib
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import time
+from typing import Optional, TYPE_CHECKING
+if TYPE_CHECKING:
+    from knobs import KnobManager
 from pipedalclient import *
+from util import log
+from util.metrics import MetricsServer, MetricsDumper
+from util.snapshot import load_snapshot, SnapshotWriter
+import yaml
 
 URI = "ws://127.0.0.1/pipedal"
+# default of max_control_rate in config.yml
+MAX_CONTROL_RATE = 30
+# seconds before a group process that exited is started again
+RESTART_DELAY = 5.0
 
+logger = log.get_logger("main")
 
 
+def start_metrics(config: Optional[dict], index: int = 0, group_name: Optional[str] = None) -> None:
+    """
+    :param index: Offset to the metrics port, so that every group process serves its own.
+    :param group_name: Group of this process, to name its dump file after.
+    """
+    if config is None:
+        return
+    if config.get("port") is not None:
+        port = int(config["port"]) + index
+        try:
+            MetricsServer(port)
+        except OSError as e:
+            # e.g. the port is taken, the knobs work without metrics
+            logger.error("metrics_failed", "Serving metrics failed", port=port, error=repr(e))
+    if config.get("dump_file") is not None:
+        path = config["dump_file"] if group_name is None else group_path(config["dump_file"], group_name)
+        MetricsDumper(path, float(config.get("dump_interval", 10)))
 
-async def main():
-    client: Optional[PiPedalClient] = await PiPedalClient.create(URI)
 
-    await client.connect()
+def group_path(path: str, group_name: str) -> str:
+    """
+    Name a file after a group, e.g. /var/tmp/pipedal-knob.snapshot.json becomes
+    /var/tmp/pipedal-knob.snapshot.<group>.json.
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.{group_name}{ext}"
 
-    knob_manager: KnobManager = KnobManager(client)
 
-    while True:
-        await asyncio.sleep(1)
+def load_groups(config: dict) -> list[dict]:
+    """
+    The knob groups of config.yml. Every group has its own PiPedal server and
+    knobs, and snapshot, plugin cache and capture files of its own, which are
+    named after the group unless the group sets them. Without groups, the
+    top-level knobs are a single group.
+    :raises ValueError: If group names or displays are used twice.
+    """
+    groups = config.get("groups")
+    if groups is None:
+        groups = [{"name": "default", "knobs": config["knobs"]}]
+
+    result = []
+    displays: dict[tuple[int, int], str] = {}
+    for i, group in enumerate(groups):
+        name = str(group.get("name", i))
+        if any(x["name"] == name for x in result):
+            raise ValueError(f"Group name {name!r} is used more than once in config.yml")
+        for knob_config in group["knobs"]:
+            display = (int(knob_config.get("i2c_port", 1)), int(knob_config["display_addr"]))
+            if display in displays:
+                raise ValueError(f"Display {display[1]:#x} on I2C port {display[0]} is used by groups {displays[display]!r} and {name!r}")
+            displays[display] = name
+
+        files = {}
+        for key in ("snapshot_file", "plugin_cache_file", "capture_file"):
+            path = group.get(key, config.get(key))
+            if path is not None and key not in group and len(groups) > 1:
+                path = group_path(path, name)
+            files[key] = path
+        result.append({
+            "name": name,
+            "server": group.get("server", config.get("server", URI)),
+            "max_control_rate": float(group.get("max_control_rate", config.get("max_control_rate", MAX_CONTROL_RATE))),
+            "knobs": group["knobs"],
+            "backend": group.get("backend", config.get("backend") or {}),
+            **files,
+        })
+    return result
+
+
+async def run_group(group: dict) -> None:
+    """
+    Connect a group's knobs to its server, until the connection is closed.
+    """
+    # luma, PIL and gpiozero take a while to import on a Pi, so import them while the client connects
+    knobs_import = asyncio.get_running_loop().run_in_executor(None, importlib.import_module, "knobs")
+
+    client: Optional[PiPedalClient] = await PiPedalClient.create(group["server"], max_control_rate=group["max_control_rate"], capture_path=group["capture_file"], plugin_cache_path=group["plugin_cache_file"])
+    connecting = asyncio.create_task(client.connect())
+
+    knobs = await knobs_import
+    knob_manager: KnobManager = knobs.KnobManager(client, group["knobs"], group["backend"])
+
+    # show the last known state right away, it is reconciled with the server's once connected
+    snapshot_path = group["snapshot_file"]
+    snapshot_writer: Optional[SnapshotWriter] = None
+    if snapshot_path is not None:
+        snapshot = load_snapshot(snapshot_path)
+        if snapshot is not None:
+            knob_manager.restore(snapshot)
+        snapshot_writer = SnapshotWriter(snapshot_path, knob_manager.snapshot)
+
+    try:
+        await connecting
+        await client.wait_closed()
+    finally:
+        if snapshot_writer is not None:
+            snapshot_writer.close()
+        knob_manager.close()
+        await client.close()
+
+
+async def run_groups(groups: list[dict]) -> None:
+    results = await asyncio.gather(*(run_group(group) for group in groups), return_exceptions=True)
+    for group, result in zip(groups, results):
+        if isinstance(result, BaseException):
+            logger.error("group_failed", "Knob group failed", group=group["name"], error=repr(result))
+
+
+def stop_on_signal(signum: int, frame) -> None:
+    raise KeyboardInterrupt()
+
+
+def run_group_process(config: dict, group: dict, index: int) -> None:
+    # the supervisor stops processes with SIGTERM, which would skip the cleanup of run_group()
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    log_writer = log.configure(config.get("logging"))
+    start_metrics(config.get("metrics"), index, group["name"])
+    try:
+        asyncio.run(run_group(group))
+    except KeyboardInterrupt:
+        # Ctrl+C reaches every process, the supervisor stops the others
+        pass
+    finally:
+        log_writer.close()
+
+
+def supervise_group_processes(config: dict, groups: list[dict]) -> None:
+    """
+    Run every group in a process of its own, so that a slow I2C bus or server
+    only holds up its own group, and restart processes that exit.
+    """
+    ports: dict[int, set[str]] = {}
+    for group in groups:
+        for knob_config in group["knobs"]:
+            ports.setdefault(int(knob_config.get("i2c_port", 1)), set()).add(group["name"])
+    for port, names in ports.items():
+        if len(names) > 1:
+            logger.warning("shared_port", "Groups in different processes share an I2C port, their frames are not arbitrated", port=port, groups=sorted(names))
+
+    # spawned, so the processes do not inherit the threads of this one
+    context = multiprocessing.get_context("spawn")
+    processes: list[Optional[multiprocessing.Process]] = [None] * len(groups)
+    restart_at: list[float] = [0.0] * len(groups)
+    try:
+        while True:
+            now = time.monotonic()
+            for i, group in enumerate(groups):
+                process = processes[i]
+                if process is not None and not process.is_alive():
+                    logger.error("group_exited", "Knob group process exited", group=group["name"], exitcode=process.exitcode)
+                    processes[i] = None
+                    restart_at[i] = now + RESTART_DELAY
+                if processes[i] is None and now >= restart_at[i]:
+                    process = context.Process(target=run_group_process, args=(config, group, i), name=f"group-{group['name']}")
+                    process.start()
+                    processes[i] = process
+            sentinels = [process.sentinel for process in processes if process is not None]
+            pending = [at - now for at, process in zip(restart_at, processes) if process is None]
+            multiprocessing.connection.wait(sentinels, timeout=max(min(pending), 0.0) if len(pending) > 0 else None)
+    finally:
+        for process in processes:
+            if process is not None:
+                process.terminate()
+        for process in processes:
+            if process is not None:
+                process.join()
+
+
+def main() -> None:
+    with open("config.yml", "r") as f:
+        config = yaml.safe_load(f)
+    groups = load_groups(config)
+
+    log_writer = log.configure(config.get("logging"))
+    try:
+        if config.get("process_per_group", False) and len(groups) > 1:
+            supervise_group_processes(config, groups)
+        else:
+            start_metrics(config.get("metrics"))
+            asyncio.run(run_groups(groups))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log_writer.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -1,10 +1,17 @@
-from pipedalclient.client import PiPedalClient, message_handler
-from pipedalclient.pedalboard import Pedalboard, PedalboardItem, PedalboardItemControl
+from pipedalclient.client import PiPedalClient, PiPedalError, ConnectionState, message_handler
+from pipedalclient.pedalboard import Pedalboard, PedalboardItem, PedalboardItemControl, ValueOrigin
+from pipedalclient.plugininfo import PluginInfo, PortInfo, ScalePoint
 
 __all__ = [
     "PiPedalClient",
+    "PiPedalError",
+    "ConnectionState",
     "message_handler",
     "Pedalboard",
     "PedalboardItem",
     "PedalboardItemControl",
+    "ValueOrigin",
+    "PluginInfo",
+    "PortInfo",
+    "ScalePoint",
 ]
\ No newline at end of file
@@ -1,11 +1,23 @@
 from __future__ import annotations
-from pipedalclient.pedalboard import Pedalboard
+from pipedalclient.pedalboard import Pedalboard, ValueOrigin
+from pipedalclient.plugininfo import PluginInfo, PluginInfoCache
+from pipedalclient.sendqueue import ControlSendQueue
+from pipedalclient.traffic import TrafficRecorder, INBOUND, OUTBOUND
 
 import websockets
 import json
-from typing import Callable, Optional
+from typing import Any, Callable, Optional
 import asyncio
+import itertools
+import random
+import time
+from enum import Enum
 from events import Event
+from util.log import get_logger
+from util.metrics import metrics, Histogram
+from util.snapshot import load_snapshot, save_snapshot
+
+log = get_logger(__name__)
 
 _message_handlers: dict[str, list[Callable]] = {}
 def message_handler(message_type: str):
@@ -16,61 +28,299 @@ def message_handler(message_type: str):
         return func
     return decorator
 
+class PiPedalError(Exception):
+    """
+    Raised when PiPedal answers a request with an error.
+    """
+    pass
+
+class ConnectionState(Enum):
+    CONNECTING = 0
+    CONNECTED = 1
+    DISCONNECTED = 2
+
 class PiPedalClient():
-    __ws: websockets.ClientConnection
+    DEFAULT_REQUEST_TIMEOUT = 5.0
+    RECONNECT_BASE_DELAY = 0.25
+    RECONNECT_MAX_DELAY = 5.0
+    # the plugin list of a rig with many plugins is large, several MiB
+    PLUGINS_REQUEST_TIMEOUT = 30.0
+    MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+    # a failed plugin list request is retried after this many seconds, doubling up to the maximum
+    PLUGINS_RETRY_DELAY = 60.0
+    PLUGINS_RETRY_MAX_DELAY = 3600.0
+
+    __url: str
+    __ws: Optional[websockets.ClientConnection]
     __client_id: int = -1
     __pedalboard: Optional[Pedalboard] = None
-    __on_pedalboard_changed: Event[Pedalboard] = Event()
+    __on_pedalboard_changed: Event[Pedalboard]
     __loop: asyncio.AbstractEventLoop
+    __control_queue: ControlSendQueue
+    __reply_ids: itertools.count
+    __pending_replies: dict[int, asyncio.Future]
+    __supervisor_task: asyncio.Task
+    __connected: asyncio.Event
+    __connection_state: ConnectionState
+    __on_connection_state_changed: Event[ConnectionState]
+    echoes_suppressed: int
+    remote_changes_applied: int
+    last_recovery_time: Optional[float]
+    __recorder: Optional[TrafficRecorder]
+    __plugin_info: PluginInfoCache
+    __plugin_cache_path: Optional[str]
+    __plugin_cache_uris: set[str]
+    __plugins_requested: bool
+    __plugins_failures: int
+    __plugins_retry_at: float
+    __plugins_task: Optional[asyncio.Task]
+    __plugins_retry: Optional[asyncio.TimerHandle]
+    __dispatch_time: Histogram
 
     @property
     def on_pedalboard_changed(self) -> Event[Pedalboard]:
-        if self.__on_pedalboard_changed is None:
-            self.__on_pedalboard_changed = Event()
         return self.__on_pedalboard_changed
 
+    @property
+    def url(self) -> str:
+        return self.__url
+
     @property
     def pedalboard(self) -> Optional[Pedalboard]:
         return self.__pedalboard
 
+    @property
+    def control_queue(self) -> ControlSendQueue:
+        return self.__control_queue
+
+    @property
+    def connection_state(self) -> ConnectionState:
+        return self.__connection_state
+
+    @property
+    def on_connection_state_changed(self) -> Event[ConnectionState]:
+        return self.__on_connection_state_changed
+
     @classmethod
-    async def create(cls, url: str) -> PiPedalClient:
+    async def create(cls, url: str, max_control_rate: float = 50.0, capture_path: Optional[str] = None, plugin_cache_path: Optional[str] = None) -> PiPedalClient:
+        """
+        Create a client for a PiPedal server. The connection is established by connect().
+        :param url: Websocket URL of the PiPedal server.
+        :param max_control_rate: Maximum number of times per second pending setControl values are flushed.
+        :param capture_path: If given, all inbound and outbound frames are recorded to this file (see pipedalclient.traffic).
+        :param plugin_cache_path: File to keep the metadata of the plugins in use in, so it need not be requested at every start.
+        """
         obj = cls()
-        obj.__ws = await websockets.connect(url)
+        obj.__url = url
+        obj.__ws = None
+        obj.__recorder = TrafficRecorder(capture_path) if capture_path is not None else None
+        obj.echoes_suppressed = 0
+        obj.remote_changes_applied = 0
+        obj.last_recovery_time = None
+        obj.__control_queue = ControlSendQueue(obj.send_set_control_async, max_control_rate, metric_labels={"server": url})
+        obj.__reply_ids = itertools.count(1)
+        obj.__pending_replies = {}
+        obj.__connection_state = ConnectionState.DISCONNECTED
+        obj.__on_pedalboard_changed = Event()
+        obj.__on_connection_state_changed = Event()
+        plugin_cache = load_snapshot(plugin_cache_path) if plugin_cache_path is not None else None
+        obj.__plugin_info = PluginInfoCache(plugin_cache)
+        obj.__plugin_cache_path = plugin_cache_path
+        obj.__plugin_cache_uris = set(plugin_cache.keys()) if plugin_cache is not None else set()
+        obj.__plugins_requested = False
+        obj.__plugins_failures = 0
+        obj.__plugins_retry_at = 0.0
+        obj.__plugins_task = None
+        obj.__plugins_retry = None
+
+        labels = {"server": url}
+        obj.__dispatch_time = metrics.histogram("pipedal_message_dispatch_seconds", "Time spent handling a received message", labels)
+        metrics.gauge("pipedal_remote_changes_total", lambda: obj.remote_changes_applied, "Control changes applied from other clients", labels)
+        metrics.gauge("pipedal_connected", lambda: 1 if obj.__connection_state == ConnectionState.CONNECTED else 0, "Whether the client is connected", labels)
+        metrics.gauge("pipedal_last_recovery_seconds", lambda: obj.last_recovery_time or 0, "Time from the last connection loss until the state was resynced", labels)
         return obj
 
     async def connect(self) -> None:
-        await self.__ws.send(json.dumps([{"message": "hello", "replyTo": 1}]))
-
-        # run receive thread asynchronously
+        """
+        Start the connection supervisor and wait until the first connection is
+        established. The supervisor keeps reconnecting with jittered exponential
+        backoff whenever the connection drops, and resyncs the state by saying
+        hello and fetching the current pedalboard again. setControl values are
+        held back while disconnected, with only the latest value per control kept.
+        """
         self.__loop = asyncio.get_event_loop()
-        asyncio.create_task(self.__receive_thread())
+        self.__connected = asyncio.Event()
+        # setControl messages need the clientId from the hello response
+        self.__control_queue.start(self.__loop, self.__connected.wait)
+        self.__supervisor_task = asyncio.create_task(self.__supervise())
+        await self.__connected.wait()
+
+    async def wait_closed(self) -> None:
+        """
+        Wait until the client is closed.
+        """
+        await asyncio.gather(self.__supervisor_task, return_exceptions=True)
+
+    async def close(self) -> None:
+        # cancelled first, so that the request failing with the connection is not retried
+        if self.__plugins_task is not None:
+            self.__plugins_task.cancel()
+        if self.__plugins_retry is not None:
+            self.__plugins_retry.cancel()
+        self.__supervisor_task.cancel()
+        self.__control_queue.stop()
+        if self.__ws is not None:
+            await self.__ws.close()
+        await self.wait_closed()
+        if self.__recorder is not None:
+            self.__recorder.close()
+            self.__recorder = None
+
+    async def __send(self, frame: str) -> None:
+        if self.__recorder is not None:
+            self.__recorder.record(OUTBOUND, frame)
+        await self.__ws.send(frame)
+
+    def __set_connection_state(self, state: ConnectionState) -> None:
+        if self.__connection_state != state:
+            self.__connection_state = state
+            self.__on_connection_state_changed(state)
+
+    def __reconnect_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.RECONNECT_MAX_DELAY, self.RECONNECT_BASE_DELAY * 2 ** attempt))
+
+    async def __supervise(self) -> None:
+        attempt = 0
+        disconnected_at: Optional[float] = None
+        while True:
+            self.__set_connection_state(ConnectionState.CONNECTING)
+            try:
+                self.__ws = await websockets.connect(self.__url, max_size=self.MAX_MESSAGE_SIZE)
+            except Exception as e:
+                delay = self.__reconnect_delay(attempt)
+                attempt += 1
+                log.warning("connect_failed", "Connecting to PiPedal failed", url=self.__url, error=str(e), retry_in=round(delay, 2))
+                await asyncio.sleep(delay)
+                continue
+
+            # run receive thread asynchronously
+            receive_task = asyncio.create_task(self.__receive_thread())
+            try:
+                # both requests are in flight at the same time
+                await asyncio.gather(self.request("hello"), self.request("currentPedalboard"))
+            except Exception as e:
+                log.warning("handshake_failed", "Handshake with PiPedal failed", url=self.__url, error=str(e))
+                await self.__ws.close()
+                await self.__wait_received(receive_task)
+                delay = self.__reconnect_delay(attempt)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+
+            attempt = 0
+            if disconnected_at is not None:
+                self.last_recovery_time = time.monotonic() - disconnected_at
+                log.info("reconnected", "Reconnected to PiPedal", url=self.__url, latency=round(self.last_recovery_time, 3))
+            self.__connected.set()
+            self.__set_connection_state(ConnectionState.CONNECTED)
+            # a request of the previous connection failed with it
+            self.__plugins_requested = False
+            self.__update_plugin_info()
+
+            await self.__wait_received(receive_task)
+
+            self.__connected.clear()
+            disconnected_at = time.monotonic()
+            self.__set_connection_state(ConnectionState.DISCONNECTED)
+
+    async def request(self, message: str, body: Any = None, timeout: Optional[float] = DEFAULT_REQUEST_TIMEOUT) -> Any:
+        """
+        Send a request and wait for its reply. Any number of requests may be in flight at once.
+        :param message: Message type of the request.
+        :param body: Optional body of the request.
+        :param timeout: Seconds to wait for the reply, or None to wait indefinitely.
+        :return: Body of the reply, or None if the reply has no body.
+        :raises PiPedalError: If the server replied with an error.
+        :raises TimeoutError: If no reply arrived in time.
+        """
+        reply_id = next(self.__reply_ids)
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.__pending_replies[reply_id] = future
+
+        request: list = [{"message": message, "replyTo": reply_id}]
+        if body is not None:
+            request.append(body)
+        try:
+            await self.__send(json.dumps(request))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.__pending_replies.pop(reply_id, None)
 
     @property
     def client_id(self) -> int:
         return self.__client_id
 
+    async def __wait_received(self, receive_task: asyncio.Task) -> None:
+        # the supervisor must outlive anything going wrong in the receive loop, or the client never reconnects
+        try:
+            await receive_task
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("receive_failed", "Receiving from PiPedal failed", url=self.__url)
+            await self.__ws.close()
+
     async def __receive_thread(self) -> None:
+        try:
+            await self.__receive_messages()
+        finally:
+            for future in self.__pending_replies.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection to PiPedal closed"))
+
+    async def __receive_messages(self) -> None:
         while True:
             try:
                 response = await self.__ws.recv()
+            except websockets.exceptions.ConnectionClosed:
+                log.info("connection_closed", "Connection closed", url=self.__url)
+                break
+            if self.__recorder is not None:
+                self.__recorder.record(INBOUND, response)
+
+            dispatch_start = time.perf_counter()
+            try:
                 root = json.loads(response)
                 message_type = root[0].get("message")
-                if message_type in _message_handlers:
-                    for handler in _message_handlers[message_type]:
-                        await handler(self, root)
-                elif message_type == "error":
-                    print(f"Error: {root[1]}")
+                handlers = _message_handlers.get(message_type, [])
+                future = self.__pending_replies.get(root[0].get("reply"))
+                body = root[1] if len(root) > 1 else None
+            except (ValueError, TypeError, LookupError, AttributeError) as e:
+                log.warning("invalid_message", "Received a malformed message", url=self.__url, error=repr(e))
+                continue
+
+            # handlers run before the reply is resolved, so requesters see the updated state
+            for handler in handlers:
+                try:
+                    await handler(self, root)
+                except Exception:
+                    log.exception("handler_failed", "Message handler failed", message_type=message_type)
+
+            if future is not None and not future.done():
+                if message_type == "error":
+                    future.set_exception(PiPedalError(body))
                 else:
-                    print(f"Unhandled message type: {message_type}")
-            except websockets.exceptions.ConnectionClosed:
-                print("Connection closed")
-                break
+                    future.set_result(body)
+            elif message_type == "error":
+                log.error("server_error", "PiPedal reported an error", error=body)
+            elif len(handlers) == 0:
+                log.debug("unhandled_message", "Unhandled message type", message_type=message_type)
+            self.__dispatch_time.observe_since(dispatch_start)
 
     @message_handler("ehlo")
     async def __onHelloResponse(client: PiPedalClient, root):
         client.__client_id = int(root[1])
-        print(f"Hello response received, clientId: {client.__client_id}")
+        log.info("hello", "Hello response received", url=client.__url, clientId=client.__client_id)
 
     @message_handler("onControlChanged")
     async def __onControlChanged(client: PiPedalClient, root):
@@ -78,26 +328,107 @@ class PiPedalClient():
         symbol = root[1].get("symbol")
         value = root[1].get("value")
 
+        # values sent on behalf of this client are echoes while newer values of it are in flight;
+        # the server's version of the last one (e.g. clamped or quantized) is applied
+        own = root[1].get("clientId") == client.__client_id
+        if client.__control_queue.acknowledge(instance, symbol, value, own):
+            origin = ValueOrigin.SERVER_ECHO
+            client.echoes_suppressed += 1
+        else:
+            origin = ValueOrigin.SERVER_REMOTE
+            client.remote_changes_applied += 1
+
         if client.pedalboard is not None:
-            client.pedalboard.item(instance).control(symbol).value = value
-        print(f"Control changed: {symbol} = {value}")
+            try:
+                client.pedalboard.item(instance).control(symbol).set_value(value, origin)
+            except KeyError as e:
+                log.warning("unknown_control", "Control changed for unknown control", instanceId=instance, symbol=symbol)
+                return
+        log.debug("control_changed", "Control changed", instanceId=instance, symbol=symbol, value=value, origin=origin.name)
 
     @message_handler("onPedalboardChanged")
     async def __onPedalboardChanged(client: PiPedalClient, root):
-        pb = Pedalboard(client, root[1]["pedalboard"])
-        client.__pedalboard = pb
-        client.on_pedalboard_changed(pb)
-        print(f"Pedalboard changed.")
+        client.__apply_pedalboard(root[1]["pedalboard"])
+        log.info("pedalboard_changed", "Pedalboard changed", url=client.__url)
 
     @message_handler("currentPedalboard")
     async def __onCurrentPedalboard(client: PiPedalClient, root):
-        pb = Pedalboard(client, root[1])
-        client.__pedalboard = pb
-        client.on_pedalboard_changed(pb)
-        print(f"Current pedalboard received.")
+        client.__apply_pedalboard(root[1])
+        log.info("current_pedalboard", "Current pedalboard received", url=client.__url)
+
+    def __apply_pedalboard(self, json_root: dict) -> None:
+        # the first pedalboard creates the model, later ones are reconciled into it in place
+        if self.__pedalboard is None:
+            self.__pedalboard = Pedalboard(self, json_root)
+            self.on_pedalboard_changed(self.__pedalboard)
+        else:
+            self.__pedalboard.update(json_root)
+        self.__update_plugin_info()
+
+    def plugin_info(self, uri: str) -> Optional[PluginInfo]:
+        """
+        Metadata of a plugin, or None if it is not known (yet).
+        """
+        return self.__plugin_info.get(uri)
+
+    def __update_plugin_info(self) -> None:
+        # persist the metadata of plugins newly in use, and ask for the plugin list if any is unknown
+        if self.__pedalboard is None:
+            return
+        uris = {item.uri for item in self.__pedalboard.items}
+        if self.__plugin_cache_path is not None and not uris <= self.__plugin_cache_uris:
+            known = {uri for uri in uris if uri in self.__plugin_info}
+            if not known <= self.__plugin_cache_uris:
+                self.__plugin_cache_uris |= known
+                try:
+                    save_snapshot(self.__plugin_cache_path, self.__plugin_info.to_json(self.__plugin_cache_uris))
+                except OSError as e:
+                    log.error("plugin_cache_failed", "Writing plugin cache failed", path=self.__plugin_cache_path, error=str(e))
+        if self.__connection_state != ConnectionState.CONNECTED or self.__plugins_requested:
+            return
+        if time.monotonic() < self.__plugins_retry_at:
+            return
+        if all(uri in self.__plugin_info for uri in uris):
+            return
+        # the plugin list contains every installed plugin, so it is requested once per session at most
+        self.__plugins_requested = True
+        self.__plugins_task = asyncio.create_task(self.__request_plugin_info())
+
+    async def __request_plugin_info(self) -> None:
+        try:
+            plugins = await self.request("plugins", timeout=self.PLUGINS_REQUEST_TIMEOUT)
+        except Exception as e:
+            # the reply itself may have caused the failure, e.g. by closing the connection, so
+            # asking again right after the reconnect could fail the same way: back off across sessions
+            delay = min(self.PLUGINS_RETRY_DELAY * 2 ** self.__plugins_failures, self.PLUGINS_RETRY_MAX_DELAY)
+            self.__plugins_failures += 1
+            self.__plugins_retry_at = time.monotonic() + delay
+            log.warning("plugins_failed", "Requesting plugin metadata failed", url=self.__url, error=str(e), retry_in=delay)
+            self.__plugins_requested = False
+            self.__plugins_retry = asyncio.get_running_loop().call_later(delay, self.__update_plugin_info)
+            return
+        self.__plugins_failures = 0
+        self.__plugin_info.update(plugins)
+        log.info("plugins", "Plugin metadata received", url=self.__url, plugins=len(plugins))
+        self.__update_plugin_info()
+
+    def restore_pedalboard(self, json_root: dict) -> None:
+        """
+        Show a previously saved pedalboard (see Pedalboard.to_json()) until the
+        server's current pedalboard arrives, which is then reconciled into it.
+        Does nothing if a pedalboard was received from the server already.
+        """
+        if self.__pedalboard is None:
+            self.__apply_pedalboard(json_root)
+
+    def has_pending_control(self, instance_id: int, symbol: str) -> bool:
+        """
+        Whether a local value for the control is waiting to be sent.
+        """
+        return self.__control_queue.is_pending(instance_id, symbol)
 
     def send_set_control(self, instance_id, symbol, value):
-        asyncio.run_coroutine_threadsafe(self.send_set_control_async(instance_id, symbol, value), self.__loop)
+        self.__control_queue.put(instance_id, symbol, value)
 
     async def send_set_control_async(self, instance_id, symbol, value):
         message = [
@@ -111,18 +442,11 @@ class PiPedalClient():
                 "value": value,
             }
         ]
-        print("Sent setControl ", message)
-        await self.__ws.send(json.dumps(message))
+        await self.__send(json.dumps(message))
 
     def send_current_pedalboard(self):
         asyncio.run_coroutine_threadsafe(self.send_current_pedalboard_async(), self.__loop)
 
     async def send_current_pedalboard_async(self):
-        message = [
-            {
-                "message": "currentPedalboard",
-                "replyTo": 0
-            }
-        ]
-        print("Sent currentPedalboard ", message)
-        await self.__ws.send(json.dumps(message))
\ No newline at end of file
+        log.debug("current_pedalboard_requested", "Requesting current pedalboard")
+        return await self.request("currentPedalboard")
\ No newline at end of file
@@ -2,97 +2,235 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from pipedalclient import PiPedalClient
+    from pipedalclient.plugininfo import PluginInfo, PortInfo
 
 from typing import Optional
 from events import Event
+from enum import Enum
 import asyncio
 
+class ValueOrigin(Enum):
+    # changed on this device, e.g. by turning a knob; sent to the server
+    LOCAL = 0
+    # the server confirming a value this client sent; ignored
+    SERVER_ECHO = 1
+    # changed by another client or by the server itself; applied but not sent back
+    SERVER_REMOTE = 2
+
 class Pedalboard():
+    __slots__ = ("client", "name", "__items", "__items_by_id", "__item_positions", "__on_items_changed", "__on_item_added", "__on_item_removed")
+
     def __init__(self, pipedal_client: PiPedalClient, json_root: dict):
         self.client: PiPedalClient = pipedal_client
         self.name = json_root["name"]
-        self.__items: list[PedalboardItem] = []
-        for item in json_root["items"]:
-            self.__items.append(PedalboardItem(self, item))
+        self.__on_items_changed: Event[Pedalboard] = Event()
+        self.__on_item_added: Event[PedalboardItem] = Event()
+        self.__on_item_removed: Event[PedalboardItem] = Event()
+        self.__set_items([PedalboardItem(self, item) for item in json_root["items"]])
+
+    @property
+    def on_items_changed(self) -> Event[Pedalboard]:
+        """
+        Triggered after items were added, removed or reordered by update().
+        """
+        return self.__on_items_changed
+
+    @property
+    def on_item_added(self) -> Event[PedalboardItem]:
+        return self.__on_item_added
+
+    @property
+    def on_item_removed(self) -> Event[PedalboardItem]:
+        return self.__on_item_removed
+
+    def __set_items(self, items: list[PedalboardItem]) -> None:
+        self.__items_by_id: dict[int, PedalboardItem] = {item.instance_id: item for item in items}
+        self.__item_positions: dict[PedalboardItem, int] = {item: i for i, item in enumerate(items)}
+        self.__items: list[PedalboardItem] = items
+
+    def update(self, json_root: dict) -> None:
+        """
+        Reconcile the pedalboard in place with a pedalboard received from the server.
+        Items are matched by instanceId and controls by symbol, so existing objects
+        (and everything listening to their events) survive. Only the differences
+        trigger events: value changes via the controls' on_value_changed, item and
+        control structure changes via on_item_added, on_item_removed,
+        on_items_changed and the items' on_controls_changed.
+        :param json_root: Pedalboard JSON as sent by PiPedal.
+        """
+        self.name = json_root["name"]
+
+        old_items = self.__items
+        new_items: list[PedalboardItem] = []
+        added: list[PedalboardItem] = []
+        for item_json in json_root["items"]:
+            item = self.__items_by_id.get(item_json["instanceId"])
+            if item is not None and item.uri == item_json["uri"]:
+                item.update(item_json)
+            else:
+                item = PedalboardItem(self, item_json)
+                added.append(item)
+            new_items.append(item)
+
+        if new_items == old_items:
+            return
+
+        kept = set(new_items)
+        removed = [item for item in old_items if item not in kept]
+        self.__set_items(new_items)
+
+        for item in removed:
+            self.__on_item_removed(item)
+        for item in added:
+            self.__on_item_added(item)
+        self.__on_items_changed(self)
+
+    def __contains__(self, item: PedalboardItem) -> bool:
+        return item in self.__item_positions
 
     def item(self, instanceId: int) -> PedalboardItem:
-        for item in self.__items:
-            if item.instance_id == instanceId:
-                return item
-        raise KeyError(f"Pedalboard item with instanceId {instanceId} not found")
+        item = self.__items_by_id.get(instanceId)
+        if item is None:
+            raise KeyError(f"Pedalboard item with instanceId {instanceId} not found")
+        return item
+
+    def index_of_item(self, item: PedalboardItem) -> int:
+        position = self.__item_positions.get(item)
+        if position is None:
+            raise KeyError(f"Pedalboard item {item.instance_id} not found")
+        return position
     
     def next_item(self, item: PedalboardItem) -> Optional[PedalboardItem]:
-        for i in range(len(self.__items)):
-            if self.__items[i] == item:
-                if i + 1 < len(self.__items):
-                    return self.__items[i + 1]
-                else:
-                    return None
-        raise KeyError(f"Pedalboard item {item.instance_id} not found")
+        i = self.index_of_item(item)
+        if i + 1 < len(self.__items):
+            return self.__items[i + 1]
+        return None
     
     def previous_item(self, item: PedalboardItem) -> Optional[PedalboardItem]:
-        for i in range(len(self.__items)):
-            if self.__items[i] == item:
-                if i - 1 >= 0:
-                    return self.__items[i - 1]
-                else:
-                    return None
-        raise KeyError(f"Pedalboard item {item.instance_id} not found")
+        i = self.index_of_item(item)
+        if i - 1 >= 0:
+            return self.__items[i - 1]
+        return None
     
     @property
     def items(self) -> list[PedalboardItem]:
         return self.__items
+
+    def to_json(self) -> dict:
+        """
+        Export the pedalboard in the format PiPedal sends it, limited to the
+        fields this model keeps, so it can be passed to Pedalboard() or update().
+        """
+        return {
+            "name": self.name,
+            "items": [item.to_json() for item in self.__items],
+        }
         
 
 class PedalboardItem():
+    __slots__ = ("pedalboard", "instance_id", "uri", "is_enabled", "plugin_name", "__controls", "__controls_by_symbol", "__control_positions", "__on_controls_changed")
+
     def __init__(self, pedalboard: Pedalboard, json_root: dict):
         self.pedalboard: Pedalboard = pedalboard
         self.instance_id: int = json_root["instanceId"]
         self.uri: str = json_root["uri"]
         self.is_enabled: bool = json_root["isEnabled"]
         self.plugin_name: str = json_root["pluginName"]
+        self.__on_controls_changed: Event[PedalboardItem] = Event()
+        self.__set_controls([PedalboardItemControl(self, control) for control in json_root["controlValues"]])
 
-        self.__controls: list[PedalboardItemControl] = []
-        for control in json_root["controlValues"]:
-            self.__controls.append(PedalboardItemControl(self, control))
+    @property
+    def on_controls_changed(self) -> Event[PedalboardItem]:
+        """
+        Triggered after controls were added, removed or reordered by update().
+        """
+        return self.__on_controls_changed
+
+    def __set_controls(self, controls: list[PedalboardItemControl]) -> None:
+        self.__controls_by_symbol: dict[str, PedalboardItemControl] = {control.symbol: control for control in controls}
+        self.__control_positions: dict[PedalboardItemControl, int] = {control: i for i, control in enumerate(controls)}
+        self.__controls: list[PedalboardItemControl] = controls
+
+    def update(self, json_root: dict) -> None:
+        """
+        Reconcile the item in place with item JSON received from the server.
+        """
+        self.is_enabled = json_root["isEnabled"]
+        self.plugin_name = json_root["pluginName"]
+
+        old_controls = self.__controls
+        new_controls: list[PedalboardItemControl] = []
+        for control_json in json_root["controlValues"]:
+            control = self.__controls_by_symbol.get(control_json["key"])
+            if control is not None:
+                control.update(control_json)
+            else:
+                control = PedalboardItemControl(self, control_json)
+            new_controls.append(control)
+
+        if new_controls != old_controls:
+            self.__set_controls(new_controls)
+            self.__on_controls_changed(self)
+
+    def __contains__(self, control: PedalboardItemControl) -> bool:
+        return control in self.__control_positions
 
     def control(self, symbol: str) -> PedalboardItemControl:
-        for control in self.__controls:
-            if control.symbol == symbol:
-                return control
-        raise KeyError(f"Pedalboard item control with symbol {symbol} not found")
+        control = self.__controls_by_symbol.get(symbol)
+        if control is None:
+            raise KeyError(f"Pedalboard item control with symbol {symbol} not found")
+        return control
+
+    def index_of_control(self, control: PedalboardItemControl) -> int:
+        position = self.__control_positions.get(control)
+        if position is None:
+            raise KeyError(f"Pedalboard item control {control.symbol} not found")
+        return position
     
     def next_control(self, control: PedalboardItemControl) -> Optional[PedalboardItemControl]:
-        for i in range(len(self.__controls)):
-            if self.__controls[i] == control:
-                if i + 1 < len(self.__controls):
-                    return self.__controls[i + 1]
-                else:
-                    return None
-        raise KeyError(f"Pedalboard item control {control.symbol} not found")
+        i = self.index_of_control(control)
+        if i + 1 < len(self.__controls):
+            return self.__controls[i + 1]
+        return None
     
     def previous_control(self, control: PedalboardItemControl) -> Optional[PedalboardItemControl]:
-        for i in range(len(self.__controls)):
-            if self.__controls[i] == control:
-                if i - 1 >= 0:
-                    return self.__controls[i - 1]
-                else:
-                    return None
-        raise KeyError(f"Pedalboard item control {control.symbol} not found")
+        i = self.index_of_control(control)
+        if i - 1 >= 0:
+            return self.__controls[i - 1]
+        return None
     
     @property
     def controls(self) -> list[PedalboardItemControl]:
         return self.__controls
     
+    @property
+    def plugin_info(self) -> Optional[PluginInfo]:
+        return self.pedalboard.client.plugin_info(self.uri)
+
+    def to_json(self) -> dict:
+        return {
+            "instanceId": self.instance_id,
+            "uri": self.uri,
+            "isEnabled": self.is_enabled,
+            "pluginName": self.plugin_name,
+            "controlValues": [control.to_json() for control in self.__controls],
+        }
+
     def send_set_control(self, symbol, value):
         self.pedalboard.client.send_set_control(self.instance_id, symbol, value)
 
+    def has_pending_control(self, symbol: str) -> bool:
+        return self.pedalboard.client.has_pending_control(self.instance_id, symbol)
+
 
 class PedalboardItemControl():
+    __slots__ = ("__pedalboard_item", "symbol", "__value", "__value_origin", "__on_value_changed")
+
     def __init__(self, pedalboard_item: PedalboardItem, json_root: dict):
         self.__pedalboard_item: PedalboardItem = pedalboard_item
         self.symbol: str = json_root["key"]
         self.__value: float = json_root["value"]
+        self.__value_origin: ValueOrigin = ValueOrigin.SERVER_REMOTE
         self.__on_value_changed: Event[float] = Event()
 
     @property
@@ -105,11 +243,50 @@ class PedalboardItemControl():
     
     @value.setter
     def value(self, value: float) -> None:
-        if self.__value != value:
-            self.__value = value
-            self.__on_value_changed(value)
+        self.set_value(value, ValueOrigin.LOCAL)
+
+    @property
+    def port(self) -> Optional[PortInfo]:
+        """
+        Metadata of the control's port, or None if the plugin's metadata is not known.
+        """
+        plugin_info = self.__pedalboard_item.plugin_info
+        return plugin_info.port(self.symbol) if plugin_info is not None else None
+
+    @property
+    def value_origin(self) -> ValueOrigin:
+        """
+        Origin of the last change of the value.
+        """
+        return self.__value_origin
+
+    def set_value(self, value: float, origin: ValueOrigin) -> None:
+        """
+        Change the value. Only local changes are sent to the server, echoes of
+        values this client sent are ignored.
+        :param value: New value.
+        :param origin: Where the change came from.
+        """
+        if origin == ValueOrigin.SERVER_ECHO or self.__value == value:
+            return
+        self.__value = value
+        self.__value_origin = origin
+        self.__on_value_changed(value)
+        if origin == ValueOrigin.LOCAL:
             self.send_set_control(value)
 
+    def update(self, json_root: dict) -> None:
+        """
+        Apply a value received from the server without sending it back. A local
+        value that has not been sent yet (e.g. while reconnecting) takes precedence.
+        """
+        if self.__pedalboard_item.has_pending_control(self.symbol):
+            return
+        self.set_value(json_root["value"], ValueOrigin.SERVER_REMOTE)
+
+    def to_json(self) -> dict:
+        return {"key": self.symbol, "value": self.__value}
+
     def send_set_control(self, value):
         self.__pedalboard_item.send_set_control(self.symbol, value)
         
\ No newline at end of file
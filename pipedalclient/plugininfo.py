@@ -0,0 +1,161 @@
+from __future__ import annotations
+from typing import Iterable, NamedTuple, Optional
+import math
+
+class ScalePoint(NamedTuple):
+    value: float
+    label: str
+
+class PortInfo():
+    """
+    Metadata of a plugin's control port, from PiPedal's UiControl.
+    """
+    __slots__ = ("symbol", "name", "min_value", "max_value", "default_value", "is_logarithmic", "is_integer", "is_toggle", "is_enumeration", "range_steps", "scale_points")
+
+    # detents from min_value to max_value of continuous ports that do not specify range_steps
+    DEFAULT_STEPS = 50
+    MAX_DECIMALS = 3
+
+    def __init__(self, json_root: dict):
+        self.symbol: str = json_root["symbol"]
+        self.name: str = json_root.get("name", self.symbol)
+        self.min_value: float = json_root.get("min_value", 0.0)
+        self.max_value: float = json_root.get("max_value", 1.0)
+        self.default_value: float = json_root.get("default_value", self.min_value)
+        self.is_logarithmic: bool = json_root.get("is_logarithmic", False)
+        self.is_integer: bool = json_root.get("integer_property", False)
+        self.is_toggle: bool = json_root.get("toggle_property", False)
+        self.is_enumeration: bool = json_root.get("enumeration_property", False)
+        self.range_steps: int = json_root.get("range_steps", 0)
+        self.scale_points: tuple[ScalePoint, ...] = tuple(sorted(ScalePoint(x["value"], x["label"]) for x in json_root.get("scale_points", [])))
+
+    def to_json(self) -> dict:
+        return {
+            "symbol": self.symbol,
+            "name": self.name,
+            "min_value": self.min_value,
+            "max_value": self.max_value,
+            "default_value": self.default_value,
+            "is_logarithmic": self.is_logarithmic,
+            "integer_property": self.is_integer,
+            "toggle_property": self.is_toggle,
+            "enumeration_property": self.is_enumeration,
+            "range_steps": self.range_steps,
+            "scale_points": [{"value": x.value, "label": x.label} for x in self.scale_points],
+        }
+
+    def clamp(self, value: float) -> float:
+        return float(min(max(value, self.min_value), self.max_value))
+
+    def step(self, value: float, detents: int) -> float:
+        """
+        Move a value by a number of encoder detents in the port's own units: toggles
+        switch, enumerations move between scale points, integers change by one and
+        continuous ports by 1/range_steps (or 1/DEFAULT_STEPS) of their range, on a
+        logarithmic scale if the port is logarithmic. The result is clamped to the range.
+        """
+        if detents == 0 or self.max_value <= self.min_value:
+            return value
+        if self.is_toggle:
+            return float(self.max_value if detents > 0 else self.min_value)
+        if self.is_enumeration and len(self.scale_points) > 0:
+            values = [x.value for x in self.scale_points]
+            nearest = min(range(len(values)), key=lambda i: abs(values[i] - value))
+            return float(values[min(max(nearest + detents, 0), len(values) - 1)])
+        if self.is_integer:
+            return self.clamp(round(value) + detents)
+
+        steps = self.range_steps if self.range_steps > 1 else self.DEFAULT_STEPS
+        if self.is_logarithmic and self.min_value > 0:
+            ratio = math.log(self.max_value / self.min_value) / steps
+            position = round(math.log(max(value, self.min_value) / self.min_value) / ratio) + detents
+            return self.clamp(self.min_value * math.exp(position * ratio))
+        increment = (self.max_value - self.min_value) / steps
+        position = round((value - self.min_value) / increment) + detents
+        return self.clamp(self.min_value + position * increment)
+
+    def format(self, value: float) -> str:
+        """
+        Format a value for display: toggles as on/off, enumerations by the label of
+        the nearest scale point, integers without decimals and continuous ports with
+        as many decimals (at most MAX_DECIMALS) as it takes to tell one step from the next.
+        """
+        if self.is_toggle:
+            return "on" if value > self.min_value else "off"
+        if self.is_enumeration and len(self.scale_points) > 0:
+            return min(self.scale_points, key=lambda x: abs(x.value - value)).label
+        if self.is_integer:
+            return str(int(round(value)))
+        if self.max_value <= self.min_value:
+            return str(round(value, self.MAX_DECIMALS))
+
+        steps = self.range_steps if self.range_steps > 1 else self.DEFAULT_STEPS
+        if self.is_logarithmic and self.min_value > 0:
+            # the step size grows with the value
+            increment = max(value, self.min_value) * (math.pow(self.max_value / self.min_value, 1 / steps) - 1)
+        else:
+            increment = (self.max_value - self.min_value) / steps
+        # neighbouring steps differ in the last decimal shown
+        decimals = min(max(math.ceil(-math.log10(increment / 2)), 0), self.MAX_DECIMALS)
+        text = f"{value:.{decimals}f}"
+        # no "-0" for values that round to zero
+        if float(text) == 0:
+            text = f"{0:.{decimals}f}"
+        return text
+
+class PluginInfo():
+    """
+    Metadata of a plugin and its control ports, from PiPedal's UiPlugin.
+    """
+    __slots__ = ("uri", "name", "__ports")
+
+    def __init__(self, json_root: dict):
+        self.uri: str = json_root["uri"]
+        self.name: str = json_root.get("name", self.uri)
+        self.__ports: dict[str, PortInfo] = {port.symbol: port for port in (PortInfo(x) for x in json_root.get("controls", []))}
+
+    def port(self, symbol: str) -> Optional[PortInfo]:
+        return self.__ports.get(symbol)
+
+    @property
+    def ports(self) -> list[PortInfo]:
+        return list(self.__ports.values())
+
+    def to_json(self) -> dict:
+        return {
+            "uri": self.uri,
+            "name": self.name,
+            "controls": [port.to_json() for port in self.__ports.values()],
+        }
+
+class PluginInfoCache():
+    """
+    Plugin metadata by URI. Entries come from a cache file written by to_json()
+    and from PiPedal's plugin list, so once every plugin in use was seen the
+    server does not have to be asked again.
+    """
+
+    def __init__(self, json_root: Optional[dict] = None):
+        self.__plugins: dict[str, PluginInfo] = {}
+        if json_root is not None:
+            self.update(json_root.values())
+
+    def __contains__(self, uri: str) -> bool:
+        return uri in self.__plugins
+
+    def get(self, uri: str) -> Optional[PluginInfo]:
+        return self.__plugins.get(uri)
+
+    def update(self, plugins: Iterable[dict]) -> None:
+        """
+        Add or replace plugins from UiPlugin JSON.
+        """
+        for plugin in plugins:
+            info = PluginInfo(plugin)
+            self.__plugins[info.uri] = info
+
+    def to_json(self, uris: Iterable[str]) -> dict:
+        """
+        Export the given plugins, e.g. the ones in use, skipping unknown URIs.
+        """
+        return {uri: self.__plugins[uri].to_json() for uri in uris if uri in self.__plugins}
@@ -0,0 +1,195 @@
+from __future__ import annotations
+from typing import Awaitable, Callable, Optional
+from collections import OrderedDict, deque
+import asyncio
+import math
+import threading
+import time
+from util.log import get_logger
+from util.metrics import metrics
+
+log = get_logger(__name__)
+
+class ControlSendQueue():
+    """
+    Coalescing, latest-value-wins send queue for setControl messages.
+
+    Values are put into a pending slot per (instanceId, symbol). A single writer
+    task flushes all pending slots at most max_rate times per second, so while a
+    knob is spun quickly only the newest value of each control goes out and the
+    intermediate ones are dropped. Slots are flushed in the order in which they
+    first became pending and the writer awaits every send before starting the
+    next one, so frames never interleave. If the socket stalls, the writer
+    simply stays blocked in the send while new values keep overwriting their
+    slots, which bounds the backlog to one value per control.
+
+    The writer waits for the optional wait_ready coroutine before every flush, so
+    values put while the connection is down are held back (latest value per
+    control) and sent once it is up again. Values whose send fails are put back
+    into their slot unless a newer value has arrived in the meantime.
+
+    Sent values are remembered as in flight until the server echoes them back,
+    or until ECHO_TIMEOUT seconds after the newest one if it never does, so that
+    acknowledge() can recognize the echoes. PiPedal echoes the values of a control in the
+    order they were sent.
+
+    put() may be called from any thread.
+    """
+
+    ECHO_TIMEOUT = 2.0
+
+    def __init__(self, send: Callable[[int, str, float], Awaitable[None]], max_rate: float = 50.0, metric_labels: Optional[dict[str, str]] = None):
+        self.__send = send
+        self.__min_interval: float = 1.0 / max_rate if max_rate > 0 else 0.0
+        # pending value and the time it was put
+        self.__pending: OrderedDict[tuple[int, str], tuple[float, float]] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__wakeup: Optional[asyncio.Event] = None
+        self.__task: Optional[asyncio.Task] = None
+        self.__wait_ready: Optional[Callable[[], Awaitable]] = None
+        self.__in_flight: dict[tuple[int, str], deque[tuple[float, float]]] = {}
+        self.__values_sent: int = 0
+        self.__values_dropped: int = 0
+        self.__echoes_acknowledged: int = 0
+
+        self.__queue_latency = metrics.histogram("setcontrol_queue_seconds", "Time from a model update to its setControl being sent", metric_labels)
+        self.__echo_latency = metrics.histogram("setcontrol_echo_seconds", "Time from sending setControl to receiving its onControlChanged echo", metric_labels)
+        metrics.gauge("setcontrol_sent_total", lambda: self.__values_sent, "setControl values sent", metric_labels)
+        metrics.gauge("setcontrol_dropped_total", lambda: self.__values_dropped, "setControl values superseded before being sent", metric_labels)
+        metrics.gauge("setcontrol_echoes_total", lambda: self.__echoes_acknowledged, "onControlChanged echoes of sent values", metric_labels)
+
+    @property
+    def values_sent(self) -> int:
+        return self.__values_sent
+
+    @property
+    def values_dropped(self) -> int:
+        return self.__values_dropped
+
+    @property
+    def echoes_acknowledged(self) -> int:
+        return self.__echoes_acknowledged
+
+    @property
+    def pending_count(self) -> int:
+        with self.__lock:
+            return len(self.__pending)
+
+    def is_pending(self, instance_id: int, symbol: str) -> bool:
+        with self.__lock:
+            return (instance_id, symbol) in self.__pending
+
+    def start(self, loop: asyncio.AbstractEventLoop, wait_ready: Optional[Callable[[], Awaitable]] = None) -> None:
+        """
+        Start the writer task. Must be called from within the given event loop.
+        :param loop: Event loop the writer runs on.
+        :param wait_ready: Coroutine function that returns once values can be sent.
+        """
+        self.__loop = loop
+        self.__wait_ready = wait_ready
+        self.__wakeup = asyncio.Event()
+        self.__task = loop.create_task(self.__writer())
+        # values queued before the writer existed
+        if self.pending_count > 0:
+            self.__wakeup.set()
+
+    def stop(self) -> None:
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+
+    def put(self, instance_id: int, symbol: str, value: float) -> None:
+        """
+        Queue a value for sending, replacing any value of the same control that
+        has not been sent yet.
+        """
+        with self.__lock:
+            key = (instance_id, symbol)
+            if key in self.__pending:
+                self.__values_dropped += 1
+            # assigning to an existing key keeps its position in the queue
+            self.__pending[key] = (value, time.monotonic())
+
+        if self.__loop is not None and self.__wakeup is not None:
+            self.__loop.call_soon_threadsafe(self.__wakeup.set)
+
+    def acknowledge(self, instance_id: int, symbol: str, value: float, own: bool = False) -> bool:
+        """
+        Check whether a value received from the server is the echo of a value this
+        queue sent. If so, that value and all values sent before it are no longer
+        in flight.
+
+        A value the server reports on behalf of this client (own) that matches
+        none in flight is the server's version of the oldest one, e.g. clamped.
+        It is an echo too, unless it is the last value in flight and nothing
+        newer is waiting to be sent: then it is the server's final word and
+        must be applied.
+        :param own: Whether the server reported the value as sent by this client.
+        :return: True if the value is an echo.
+        """
+        with self.__lock:
+            key = (instance_id, symbol)
+            in_flight = self.__in_flight.get(key)
+            if not in_flight:
+                return own and key in self.__pending
+            # echoes arrive in order, so entries are only given up on once even the newest is overdue
+            if in_flight[-1][1] < time.monotonic() - self.ECHO_TIMEOUT:
+                in_flight.clear()
+            for i, (sent_value, sent_time) in enumerate(in_flight):
+                # PiPedal stores values as 32 bit floats
+                if math.isclose(sent_value, value, rel_tol=1e-6, abs_tol=1e-6):
+                    for _ in range(i + 1):
+                        in_flight.popleft()
+                    self.__echoes_acknowledged += 1
+                    self.__echo_latency.observe(time.monotonic() - sent_time)
+                    return True
+            if not own:
+                return False
+            if in_flight:
+                in_flight.popleft()
+            # newer values of this client are still to be echoed, and those win
+            return len(in_flight) > 0 or key in self.__pending
+
+    def __requeue(self, values: list[tuple[tuple[int, str], tuple[float, float]]]) -> None:
+        # unsent values go back to the front of the queue unless they were superseded
+        with self.__lock:
+            pending = OrderedDict((key, value) for key, value in values if key not in self.__pending)
+            pending.update(self.__pending)
+            self.__pending = pending
+        self.__wakeup.set()
+
+    async def __writer(self) -> None:
+        while True:
+            await self.__wakeup.wait()
+            self.__wakeup.clear()
+            if self.__wait_ready is not None:
+                await self.__wait_ready()
+
+            flush_start = time.monotonic()
+            with self.__lock:
+                batch = self.__pending
+                self.__pending = OrderedDict()
+
+            values = list(batch.items())
+            for i, ((instance_id, symbol), (value, put_time)) in enumerate(values):
+                # registered before sending, the echo may arrive before the send returns
+                with self.__lock:
+                    key = (instance_id, symbol)
+                    if key not in self.__in_flight:
+                        self.__in_flight[key] = deque()
+                    self.__in_flight[key].append((value, time.monotonic()))
+                try:
+                    await self.__send(instance_id, symbol, value)
+                    self.__values_sent += 1
+                    latency = time.monotonic() - put_time
+                    self.__queue_latency.observe(latency)
+                    log.debug("control_sent", "Sent setControl", instanceId=instance_id, symbol=symbol, value=value, latency=round(latency, 4))
+                except Exception as e:
+                    log.warning("control_send_failed", "Sending setControl failed", instanceId=instance_id, symbol=symbol, error=str(e))
+                    self.__requeue(values[i:])
+                    break
+
+            remaining = self.__min_interval - (time.monotonic() - flush_start)
+            if remaining > 0:
+                await asyncio.sleep(remaining)
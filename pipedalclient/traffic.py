@@ -0,0 +1,83 @@
+from __future__ import annotations
+from typing import Iterator, NamedTuple, Optional
+import gzip
+import queue
+import threading
+import time
+import zlib
+
+INBOUND = "<"
+OUTBOUND = ">"
+
+class TrafficFrame(NamedTuple):
+    time: float
+    """Seconds since the recording started."""
+    direction: str
+    """INBOUND or OUTBOUND."""
+    frame: str
+    """The websocket frame as sent or received."""
+
+class TrafficRecorder():
+    """
+    Records websocket frames with timestamps to a gzip compressed log file.
+
+    Every frame is one line of the form "<seconds>\\t<direction>\\t<frame>", where
+    frames are PiPedal's single-line JSON. record() only enqueues the frame,
+    compression and file I/O happen on a background thread so that recording
+    does not slow down the receive loop.
+
+    The file is flushed every FLUSH_INTERVAL seconds, so a process that is
+    killed leaves a log that read_traffic() can read up to the last flush.
+    """
+    FLUSH_INTERVAL = 5.0
+
+    def __init__(self, path: str):
+        self.__file = gzip.open(path, "wt", encoding="utf-8")
+        self.__start: float = time.monotonic()
+        self.__queue: queue.SimpleQueue[Optional[tuple[float, str, str]]] = queue.SimpleQueue()
+        self.__thread = threading.Thread(target=self.__run, name="traffic-recorder", daemon=True)
+        self.__thread.start()
+
+    def record(self, direction: str, frame: str) -> None:
+        self.__queue.put((time.monotonic() - self.__start, direction, frame))
+
+    def close(self) -> None:
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self) -> None:
+        with self.__file:
+            flush_at: Optional[float] = None
+            while True:
+                try:
+                    entry = self.__queue.get(timeout=max(flush_at - time.monotonic(), 0.0) if flush_at is not None else None)
+                except queue.Empty:
+                    # a sync flush ends the data compressed so far on a byte boundary, so it can be decompressed
+                    self.__file.flush()
+                    flush_at = None
+                    continue
+                if entry is None:
+                    return
+                timestamp, direction, frame = entry
+                self.__file.write(f"{timestamp:.6f}\t{direction}\t{frame}\n")
+                if flush_at is None:
+                    flush_at = time.monotonic() + self.FLUSH_INTERVAL
+                elif time.monotonic() >= flush_at:
+                    self.__file.flush()
+                    flush_at = None
+
+def read_traffic(path: str) -> Iterator[TrafficFrame]:
+    """
+    Read a log written by TrafficRecorder. The log of a process that was killed
+    ends without the gzip trailer and possibly in the middle of a frame, it is
+    read up to the last complete frame.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if not line.endswith("\n"):
+                    return
+                timestamp, direction, frame = line[:-1].split("\t", 2)
+                yield TrafficFrame(float(timestamp), direction, frame)
+        except (EOFError, zlib.error):
+            return
@@ -0,0 +1,90 @@
+import asyncio
+import unittest
+
+from benchmarks.standin import PiPedalStandIn, synthetic_pedalboard, to_float32
+from pipedalclient import PiPedalClient
+from pipedalclient.pedalboard import ValueOrigin
+from pipedalclient.sendqueue import ControlSendQueue
+
+class AcknowledgeTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.sent: list[tuple[int, str, float]] = []
+
+        async def send(instance_id: int, symbol: str, value: float) -> None:
+            self.sent.append((instance_id, symbol, value))
+
+        self.queue = ControlSendQueue(send, max_rate=0)
+        self.queue.start(asyncio.get_running_loop())
+
+    async def asyncTearDown(self):
+        self.queue.stop()
+
+    async def flush(self, *values: float) -> None:
+        for value in values:
+            self.queue.put(1, "gain", value)
+            while self.queue.pending_count > 0 or len(self.sent) == 0 or self.sent[-1][2] != value:
+                await asyncio.sleep(0)
+
+    async def test_echoes_in_order(self):
+        await self.flush(0.1, 0.2, 0.3)
+        self.assertTrue(self.queue.acknowledge(1, "gain", 0.1, own=True))
+        self.assertTrue(self.queue.acknowledge(1, "gain", 0.2, own=True))
+        self.assertTrue(self.queue.acknowledge(1, "gain", 0.3, own=True))
+        self.assertEqual(self.queue.echoes_acknowledged, 3)
+
+    async def test_more_values_in_flight_than_before(self):
+        values = [i / 100 for i in range(40)]
+        await self.flush(*values)
+        for value in values:
+            self.assertTrue(self.queue.acknowledge(1, "gain", value, own=True))
+
+    async def test_own_value_with_newer_in_flight_is_echo(self):
+        await self.flush(0.1, 0.2)
+        # the server's version of 0.1, e.g. quantized
+        self.assertTrue(self.queue.acknowledge(1, "gain", 0.15, own=True))
+        self.assertTrue(self.queue.acknowledge(1, "gain", 0.2, own=True))
+
+    async def test_own_correction_of_last_value_is_applied(self):
+        await self.flush(0.1, 2.0)
+        self.assertTrue(self.queue.acknowledge(1, "gain", 0.1, own=True))
+        # the server clamped the last value
+        self.assertFalse(self.queue.acknowledge(1, "gain", 1.0, own=True))
+
+    async def test_other_client_value_is_applied(self):
+        await self.flush(0.1)
+        self.assertFalse(self.queue.acknowledge(1, "gain", 0.7, own=False))
+        self.assertFalse(self.queue.acknowledge(2, "gain", 0.1, own=False))
+
+class SlowEchoTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Regression test: echoes that lag behind many sends must not be applied as
+    remote changes, which left the model on a stale value.
+    """
+
+    async def test_model_follows_last_sent_value(self):
+        standin = PiPedalStandIn(synthetic_pedalboard(1, 1), echo_delay=0.8)
+        await standin.start()
+        client = await PiPedalClient.create(standin.url, max_control_rate=30)
+        await client.connect()
+        try:
+            control = client.pedalboard.items[0].controls[0]
+            redraws = []
+            control.on_value_changed.add_listener(redraws.append)
+
+            values = [round(0.01 * i, 2) for i in range(1, 41)]
+            for value in values:
+                control.set_value(value, ValueOrigin.LOCAL)
+                await asyncio.sleep(1 / 30)
+            await asyncio.sleep(1.5)
+
+            server_value = standin.pedalboard["items"][0]["controlValues"][0]["value"]
+            self.assertEqual(server_value, to_float32(values[-1]))
+            self.assertEqual(control.value, values[-1])
+            self.assertEqual(client.remote_changes_applied, 0)
+            self.assertEqual(redraws, values)
+        finally:
+            await client.close()
+            await standin.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+from __future__ import annotations
+from typing import Any, Optional
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+from util.metrics import metrics
+
+LEVELS: dict[str, int] = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
+
+# libraries that log every frame or event at debug level, kept at info unless configured in levels
+QUIET_LOGGERS = ("websockets", "asyncio", "PIL")
+
+class RateLimiter():
+    """
+    Token bucket per event type. Each event type may log `rate` records per
+    second on average, with bursts of up to `burst` records. Records beyond that
+    are dropped and counted, and the count is reported with the next record of
+    the same type that gets through.
+    """
+
+    def __init__(self, rate: Optional[float] = None, burst: Optional[float] = None, rates: Optional[dict[str, float]] = None):
+        """
+        :param rate: Records per second of every event type, unlimited if None.
+        :param burst: Records that may be logged at once, 2 seconds' worth if not given.
+        :param rates: Records per second of individual event types, overriding rate.
+        """
+        self.__rate = rate
+        self.__burst = burst
+        self.__rates: dict[str, float] = dict(rates or {})
+        # event -> [tokens, last refill, suppressed, counter of suppressed records]
+        self.__buckets: dict[str, list] = {}
+        self.__lock = threading.Lock()
+
+    def allow(self, event: str) -> tuple[bool, int]:
+        """
+        Take a token for a record of the given event type.
+        :return: Whether the record may be logged, and the number of records suppressed since the last one that was.
+        """
+        rate = self.__rates.get(event, self.__rate)
+        if rate is None:
+            return True, 0
+        burst = self.__burst if self.__burst is not None else max(rate * 2, 1.0)
+        now = time.monotonic()
+        with self.__lock:
+            bucket = self.__buckets.get(event)
+            if bucket is None:
+                bucket = [burst, now, 0, metrics.counter("log_records_suppressed_total", "Log records dropped by rate limiting", {"event": event})]
+                self.__buckets[event] = bucket
+            bucket[0] = min(bucket[0] + (now - bucket[1]) * rate, burst)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                bucket[3].inc()
+                return False, 0
+            bucket[0] -= 1.0
+            suppressed = bucket[2]
+            bucket[2] = 0
+            return True, suppressed
+
+_rate_limiter: RateLimiter = RateLimiter()
+
+class Logger():
+    """
+    Logger for structured records: an event type, a fixed message and fields.
+
+    Records are only created if their level is enabled and their event type is
+    not rate limited, and they are formatted and written on the writer thread
+    started by configure(), so logging from the receive loop or an input
+    callback costs a few dictionary lookups and a queue put. Pass values as
+    fields rather than formatting them into the message.
+
+    Example usage:
+        log = get_logger(__name__)
+        log.debug("control_changed", "Control changed", instanceId=3, symbol="gain", value=0.5)
+    """
+
+    def __init__(self, name: str):
+        self.__logger = logging.getLogger(name)
+
+    def is_enabled_for(self, level: int) -> bool:
+        return self.__logger.isEnabledFor(level)
+
+    def __log(self, level: int, event: str, message: str, fields: dict[str, Any], exc_info=None) -> None:
+        if not self.__logger.isEnabledFor(level):
+            return
+        allowed, suppressed = _rate_limiter.allow(event)
+        if not allowed:
+            return
+        if suppressed > 0:
+            fields["suppressed"] = suppressed
+        # makeRecord() and handle() skip the stack walk of Logger.log() for the caller's file and line
+        record = self.__logger.makeRecord(self.__logger.name, level, "", 0, message, (), exc_info, extra={"event": event, "fields": fields})
+        self.__logger.handle(record)
+
+    def debug(self, event: str, message: str, **fields) -> None:
+        self.__log(logging.DEBUG, event, message, fields)
+
+    def info(self, event: str, message: str, **fields) -> None:
+        self.__log(logging.INFO, event, message, fields)
+
+    def warning(self, event: str, message: str, **fields) -> None:
+        self.__log(logging.WARNING, event, message, fields)
+
+    def error(self, event: str, message: str, **fields) -> None:
+        self.__log(logging.ERROR, event, message, fields)
+
+    def exception(self, event: str, message: str, **fields) -> None:
+        """
+        Log an error with the traceback of the exception being handled.
+        """
+        self.__log(logging.ERROR, event, message, fields, exc_info=sys.exc_info())
+
+def get_logger(name: str) -> Logger:
+    return Logger(name)
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats records as text with key=value fields, or as one JSON object per line.
+    """
+
+    def __init__(self, json_format: bool = False):
+        super().__init__()
+        self.__json_format = json_format
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields: dict[str, Any] = getattr(record, "fields", {})
+        event: str = getattr(record, "event", "")
+        if self.__json_format:
+            root = {
+                "time": record.created,
+                "level": record.levelname.lower(),
+                "logger": record.name,
+                "event": event,
+                "message": record.getMessage(),
+            }
+            root.update(fields)
+            if record.exc_info:
+                root["exception"] = self.formatException(record.exc_info)
+            return json.dumps(root, default=str)
+
+        text = f"{self.formatTime(record)} {record.levelname} {record.name}: {record.getMessage()}"
+        if len(fields) > 0:
+            text += " " + " ".join(f"{key}={value!r}" if isinstance(value, str) else f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # records are consumed in this process, so they are queued as they are and
+    # formatted on the writer thread; a full queue drops records instead of blocking
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.counter("log_records_dropped_total", "Log records dropped because the log queue was full").inc()
+
+class LogWriter():
+    """
+    Background thread writing the records of all loggers, see configure().
+    """
+    QUEUE_SIZE = 10000
+
+    def __init__(self, handler: logging.Handler, level: int):
+        self.__queue: queue.Queue = queue.Queue(self.QUEUE_SIZE)
+        self.__handler = handler
+        self.__queue_handler = _QueueHandler(self.__queue)
+        self.__listener = logging.handlers.QueueListener(self.__queue, handler)
+        metrics.gauge("log_queue_length", self.__queue.qsize, "Log records waiting to be written")
+
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(self.__queue_handler)
+        self.__listener.start()
+
+    def close(self) -> None:
+        """
+        Write the queued records and stop the writer thread.
+        """
+        logging.getLogger().removeHandler(self.__queue_handler)
+        self.__listener.stop()
+        self.__handler.close()
+
+def configure(config: Optional[dict]) -> LogWriter:
+    """
+    Set up logging from the logging section of config.yml.
+    """
+    global _rate_limiter
+    config = config or {}
+
+    level = LEVELS[config.get("level", "info")]
+    levels: dict[str, str] = config.get("levels") or {}
+    for name in QUIET_LOGGERS:
+        if name not in levels:
+            logging.getLogger(name).setLevel(max(level, logging.INFO))
+    for name, logger_level in levels.items():
+        logging.getLogger(name).setLevel(LEVELS[logger_level])
+
+    rate_limit = config.get("rate_limit")
+    _rate_limiter = RateLimiter(
+        float(rate_limit) if rate_limit is not None else None,
+        rates={event: float(rate) for event, rate in (config.get("rate_limits") or {}).items()})
+
+    if config.get("file") is not None:
+        handler: logging.Handler = logging.FileHandler(config["file"])
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(StructuredFormatter(json_format=config.get("format", "text") == "json"))
+    return LogWriter(handler, level)
@@ -0,0 +1,215 @@
+from __future__ import annotations
+from typing import Callable, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS: tuple[float, ...] = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+def _format_labels(labels: tuple[tuple[str, str], ...], extra: Optional[tuple[str, str]] = None) -> str:
+    if extra is not None:
+        labels = labels + (extra,)
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+class Counter():
+    """
+    Monotonically increasing counter.
+    """
+
+    def __init__(self):
+        self.__value: float = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def value(self) -> float:
+        return self.__value
+
+    def inc(self, amount: float = 1) -> None:
+        with self.__lock:
+            self.__value += amount
+
+class Histogram():
+    """
+    Histogram with fixed bucket boundaries. Observing a value costs a binary search
+    and an increment, cumulative counts are only computed when rendering.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.__bounds: tuple[float, ...] = buckets
+        self.__counts: list[int] = [0] * (len(buckets) + 1)
+        self.__sum: float = 0.0
+        self.__lock = threading.Lock()
+
+    @property
+    def count(self) -> int:
+        return sum(self.__counts)
+
+    @property
+    def sum(self) -> float:
+        return self.__sum
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.__bounds, value)
+        with self.__lock:
+            self.__counts[i] += 1
+            self.__sum += value
+
+    def observe_since(self, start: float) -> None:
+        """
+        Observe the time passed since start, as returned by time.perf_counter().
+        """
+        self.observe(time.perf_counter() - start)
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        with self.__lock:
+            counts = list(self.__counts)
+        result = []
+        total = 0
+        for bound, count in zip(self.__bounds, counts):
+            total += count
+            result.append((repr(bound), total))
+        result.append(("+Inf", total + counts[-1]))
+        return result
+
+class MetricsRegistry():
+    """
+    Collection of named metrics that can be rendered in the Prometheus text format.
+    Metrics are created on first use and identified by their name and labels.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__help: dict[str, tuple[str, str]] = {}
+        self.__metrics: dict[tuple[str, tuple[tuple[str, str], ...]], object] = {}
+
+    def __get(self, kind: str, name: str, help: str, labels: Optional[dict[str, str]], factory: Callable[[], object]) -> object:
+        key = (name, tuple(sorted((labels or {}).items())))
+        metric = self.__metrics.get(key)
+        if metric is None:
+            with self.__lock:
+                metric = self.__metrics.get(key)
+                if metric is None:
+                    metric = factory()
+                    self.__metrics[key] = metric
+                    self.__help.setdefault(name, (kind, help))
+        return metric
+
+    def counter(self, name: str, help: str = "", labels: Optional[dict[str, str]] = None) -> Counter:
+        return self.__get("counter", name, help, labels, Counter)
+
+    def histogram(self, name: str, help: str = "", labels: Optional[dict[str, str]] = None, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.__get("histogram", name, help, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name: str, read: Callable[[], float], help: str = "", labels: Optional[dict[str, str]] = None) -> None:
+        """
+        Register a value that is read when the metrics are rendered, e.g. a counter
+        some object already keeps anyway. Names ending in _total are exposed as counters.
+        Registering the same name and labels again replaces the previous function.
+        """
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.__lock:
+            self.__metrics[key] = read
+            self.__help.setdefault(name, ("counter" if name.endswith("_total") else "gauge", help))
+
+    def render(self) -> str:
+        with self.__lock:
+            metrics = sorted(self.__metrics.items(), key=lambda x: x[0])
+        lines: list[str] = []
+        last_name = None
+        for (name, labels), metric in metrics:
+            if name != last_name:
+                kind, help = self.__help[name]
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                last_name = name
+            if isinstance(metric, Histogram):
+                for bound, count in metric.cumulative():
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', bound))} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {metric.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {metric.count}")
+            elif isinstance(metric, Counter):
+                lines.append(f"{name}{_format_labels(labels)} {metric.value}")
+            else:
+                try:
+                    lines.append(f"{name}{_format_labels(labels)} {metric()}")
+                except Exception:
+                    pass
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str) -> None:
+        """
+        Write the metrics to a file, replacing it atomically.
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+metrics: MetricsRegistry = MetricsRegistry()
+
+
+class MetricsServer():
+    """
+    Serves the metrics of a registry over HTTP on a background thread,
+    for scraping by Prometheus or reading with curl.
+    """
+
+    def __init__(self, port: int, host: str = "127.0.0.1", registry: MetricsRegistry = metrics):
+        """
+        :raises OSError: If the port cannot be bound, e.g. because it is in use.
+        """
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry_.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name="metrics-http", daemon=True)
+        self.__thread.start()
+
+    def close(self) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
+
+class MetricsDumper():
+    """
+    Periodically writes the metrics of a registry to a file on a background thread.
+    """
+
+    def __init__(self, path: str, interval: float = 10.0, registry: MetricsRegistry = metrics):
+        self.__path = path
+        self.__interval = interval
+        self.__registry = registry
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name="metrics-dump", daemon=True)
+        self.__thread.start()
+
+    def __run(self) -> None:
+        while not self.__stop.wait(self.__interval):
+            try:
+                self.__registry.dump(self.__path)
+            except OSError as e:
+                # imported here, util.log reports its own metrics
+                from util.log import get_logger
+                get_logger(__name__).error("metrics_dump_failed", "Writing metrics failed", path=self.__path, error=str(e))
+
+    def close(self) -> None:
+        self.__stop.set()
+        self.__thread.join()
@@ -0,0 +1,77 @@
+from __future__ import annotations
+from typing import Callable, Optional
+import json
+import os
+import threading
+
+from util.log import get_logger
+
+log = get_logger(__name__)
+
+def load_snapshot(path: str) -> Optional[dict]:
+    """
+    Read a snapshot written by save_snapshot().
+    :return: The snapshot, or None if there is none or it cannot be read.
+    """
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.warning("snapshot_read_failed", "Reading snapshot failed", path=path, error=str(e))
+        return None
+
+def save_snapshot(path: str, snapshot: dict) -> None:
+    """
+    Write a snapshot as compact JSON, replacing the previous one atomically.
+    """
+    _write(path, json.dumps(snapshot, separators=(",", ":")))
+
+def _write(path: str, data: str) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+class SnapshotWriter():
+    """
+    Periodically saves the state returned by collect on a background thread.
+
+    The file is only rewritten when the state changed since the last write, so
+    an idle rig does not wear out the SD card. collect may return None while
+    there is nothing to save. close() writes the latest state one last time.
+    """
+
+    def __init__(self, path: str, collect: Callable[[], Optional[dict]], interval: float = 5.0):
+        self.__path = path
+        self.__collect = collect
+        self.__interval = interval
+        self.__last_written: Optional[str] = None
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name="snapshot", daemon=True)
+        self.__thread.start()
+
+    def __run(self) -> None:
+        while not self.__stop.wait(self.__interval):
+            self.__write()
+
+    def __write(self) -> None:
+        try:
+            snapshot = self.__collect()
+            if snapshot is None:
+                return
+            data = json.dumps(snapshot, separators=(",", ":"))
+            if data == self.__last_written:
+                return
+            _write(self.__path, data)
+            self.__last_written = data
+        except Exception as e:
+            log.error("snapshot_write_failed", "Writing snapshot failed", path=self.__path, error=str(e))
+
+    def close(self) -> None:
+        if self.__stop.is_set():
+            return
+        self.__stop.set()
+        self.__thread.join()
+        self.__write()